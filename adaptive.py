@@ -0,0 +1,185 @@
+''' Adaptive refinement of a one dimensional scaling sweep.
+
+Instead of submitting every value of config["range"], AdaptiveRefiner starts
+from a coarse subset (the endpoints and a few evenly spaced values), extracts
+each finished point with plotter.extract_run and then picks further values of
+the range between the measured neighbours whose metric differs most, until
+the budget is spent or no interval is left to refine. Points run with repeats
+are measured by the mean event rate of their replicas once all have finished.
+
+Options come from the config "adaptive" block:
+   initial_points     number of range values submitted up front (default 3)
+   metric             "Parallel Efficiency" (default) or "Event Rate"
+   refine_batch       number of new points chosen after each finished job (default 1)
+   min_change         intervals whose metric changes by no more than this are not refined (default 0, flat intervals are never refined)
+   budget_jobs        maximum number of jobs run (points times config "repeats"),
+                      resumed results included
+   budget_node_hours  maximum node-hours, charged at the requested walltime
+                      until the measured runtime of a point is known
+'''
+import logging
+import math
+import glob
+import os
+from scheduler.sched_base import parse_walltime
+logger = logging.getLogger(__name__)
+
+METRICS = ('Parallel Efficiency','Event Rate')
+
+
+class AdaptiveRefiner:
+
+   def __init__(self, scheduler, config, make_point):
+      # make_point(x) -> (threads, ranks, job_working_path, overrides) for a range value
+      options = config['adaptive']
+      self.scheduler = scheduler
+      self.config = config
+      self.make_point = make_point
+      self.candidates = sorted(set(config['range']))
+      self.initial_points = max(options.get('initial_points',3),2)
+      self.metric = options.get('metric','Parallel Efficiency')
+      if self.metric not in METRICS:
+         raise ValueError(f"Unsupported adaptive metric: {self.metric}, use one of {', '.join(METRICS)}")
+      self.repeats = max(config.get('repeats',1),1)
+      self.refine_batch = max(options.get('refine_batch',1),1)
+      self.min_change = options.get('min_change',0.)
+      self.budget_jobs = options.get('budget_jobs')
+      self.budget_node_hours = options.get('budget_node_hours')
+      self.rates = {}     # range value -> measured event rate
+      self.failed = set()
+      self.charged = {}   # range value -> node-hours charged to the budget
+      self.paths = {}     # job_working_path -> range value
+      self.finished_replicas = {}
+      self.exhausted = False
+
+   def start(self):
+      ''' Pick up results of earlier runs and return the points to submit first. '''
+      for x in self.candidates:
+         path = self.make_point(x)[2]
+         self.paths[path] = x
+         if os.path.isdir(path):
+            self.record(x,extract(path),resumed=True)
+      if self.rates:
+         logger.info('adaptive sweep resumed with %d measured points: %s',len(self.rates),sorted(self.rates))
+
+      n = min(self.initial_points,len(self.candidates))
+      coarse = sorted(set(self.candidates[round(i * (len(self.candidates) - 1) / (n - 1))] for i in range(n))) if n > 1 else self.candidates
+      points = self.request([x for x in coarse if x not in self.charged])
+      return points if points else self.refine()
+
+   def finished(self, scripts):
+      ''' Record the results of a finished job and return the next points to submit. '''
+      for script in scripts:
+         path = script.job_working_path
+         if path not in self.paths:
+            # a replica of a point
+            path = os.path.dirname(path)
+         x = self.paths.get(path)
+         if x is None:
+            continue
+         replicas = self.finished_replicas.setdefault(x,set())
+         replicas.add(script.job_working_path)
+         if len(replicas) == self.repeats:
+            self.record(x,extract(path))
+      return self.refine()
+
+   def record(self, x, rows, resumed=False):
+      rates = [rate for rate in map(event_rate,rows) if rate is not None]
+      if not rates:
+         if not resumed:
+            logger.warning('adaptive sweep: no result for %s, it will not be refined around',x)
+            self.failed.add(x)
+         return
+      self.rates[x] = sum(rates) / len(rates)
+      runtime = sum(row.get('Bash Runtime') or 0 for row in rows if row)
+      if runtime > 0:
+         self.charged[x] = self.num_nodes(x) * runtime / 3600.
+      else:
+         self.charged.setdefault(x,self.cost(x))
+
+   def refine(self):
+      # score every interval between neighbouring measured points that still
+      # has unrequested range values inside and nothing in flight
+      measured = sorted(self.rates)
+      if len(measured) < 2:
+         return []
+      values = self.metric_values(measured)
+      intervals = []
+      for (x0,v0),(x1,v1) in zip(zip(measured,values),zip(measured[1:],values[1:])):
+         inside = [x for x in self.candidates if x0 < x < x1]
+         if any(x in self.charged and x not in self.rates and x not in self.failed for x in inside):
+            continue
+         open_values = [x for x in inside if x not in self.charged]
+         change = abs(v1 - v0)
+         if open_values and change > self.min_change:
+            intervals.append((change,len(open_values),x0,x1,open_values))
+      intervals.sort(key=lambda interval: interval[:2],reverse=True)
+
+      picks = []
+      for change,_,x0,x1,open_values in intervals[:self.refine_batch]:
+         # the value closest to the geometric middle of the interval
+         middle = math.sqrt(x0 * x1)
+         picks.append((min(open_values,key=lambda x: abs(math.log(x / middle))),x0,x1,change))
+      points = self.request([x for x,_,_,_ in picks])
+      for x,x0,x1,change in picks[:len(points)]:
+         logger.info('adaptive sweep: refining between %s and %s (%s changes by %.3g) with %s',x0,x1,self.metric,change,x)
+      return points
+
+   def metric_values(self, measured):
+      if self.metric == 'Event Rate':
+         # relative changes, so fast and slow regions of the curve compare alike
+         return [math.log2(self.rates[x]) for x in measured]
+      x0 = measured[0]
+      rate0 = self.rates[x0]
+      return [(self.rates[x] / rate0) / (x / x0) for x in measured]
+
+   def request(self, xs):
+      points = []
+      for x in xs:
+         if not self.affordable(x):
+            if not self.exhausted:
+               logger.info('adaptive sweep: budget exhausted after %d points, %.3g node-hours',len(self.charged),self.spent())
+               self.exhausted = True
+            break
+         self.charged[x] = self.cost(x)
+         points.append(self.make_point(x))
+      return points
+
+   def affordable(self, x):
+      if self.budget_jobs is not None and (len(self.charged) + 1) * self.repeats > self.budget_jobs:
+         return False
+      if self.budget_node_hours is not None and self.spent() + self.cost(x) > self.budget_node_hours:
+         return False
+      return True
+
+   def spent(self):
+      return sum(self.charged.values())
+
+   def num_nodes(self, x):
+      threads,ranks,_,overrides = self.make_point(x)
+      return self.scheduler.point_opts(self.config,threads,ranks,overrides)['num_nodes']
+
+   def cost(self, x):
+      # node-hours of all replicas at the requested walltime
+      threads,ranks,_,overrides = self.make_point(x)
+      opts = self.scheduler.point_opts(self.config,threads,ranks,overrides)
+      return self.repeats * opts['num_nodes'] * (parse_walltime(opts.get('walltime')) or 0) / 3600.
+
+
+def extract(job_working_path):
+   # rows of a point's runs, one per replica_<n> subdirectory if it was repeated;
+   # plotter pulls in pandas, matplotlib and h5py, only load it once results are needed
+   from plotter import REPLICA_DIR_RE, extract_run
+   replicas = [path for path in sorted(glob.glob(os.path.join(job_working_path,'replica_*'))) if REPLICA_DIR_RE.match(os.path.basename(path))]
+   return [extract_run(path) for path in replicas or [job_working_path]]
+
+
+def event_rate(row):
+   # events per second as in plotter.extraction_function, None if the run has no timers
+   if not row:
+      return None
+   runtime = row.get('Event Generation Runtime')
+   if not runtime or not math.isfinite(runtime) or runtime <= 0 or not row.get('Batch Size'):
+      return None
+   # ini values are extracted as strings
+   return int(row['Batch Size']) * int(row.get('N Batches',1)) / runtime
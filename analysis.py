@@ -0,0 +1,177 @@
+''' Scaling analysis of extracted sweeps.
+
+scaling_analysis() adds per point speedup, parallel efficiency and Karp-Flatt
+serial fraction columns relative to the smallest scale of a sweep, fits
+Amdahl's and Gustafson's laws to the speedup and a simple communication cost
+model to the time per event, and records the fitted curves, the model's
+optimal scale and the efficiency knee as extra columns.
+
+aggregate_replicas() reduces repeated runs of a point to one row with the mean,
+median, minimum, standard deviation and 95% confidence interval of the timer
+columns, and flag_high_variance() marks points whose spread is too large for
+the measured change between scales to be told apart from noise.
+'''
+import numpy as np
+import pandas as pd
+
+ANALYSIS_COLUMNS = [
+   'Speedup',
+   'Parallel Efficiency',
+   'Karp-Flatt Serial Fraction',
+   'Amdahl Speedup Fit',
+   'Gustafson Speedup Fit',
+   'Comm Model Rate Fit',
+   'Amdahl Serial Fraction',
+   'Gustafson Serial Fraction',
+   'Comm Model Optimal Scale',
+   'Efficiency Knee',
+]
+
+
+def scaling_analysis(df, x_key, rate_key='Event Rate', knee_efficiency=0.8):
+   # returns a copy of df sorted by x_key with the ANALYSIS_COLUMNS filled in
+   df = df.sort_values(by=x_key).reset_index(drop=True)
+   x = df[x_key].to_numpy(dtype=float)
+   rate = df[rate_key].to_numpy(dtype=float)
+   if len(df) == 0 or not np.isfinite(rate[0]) or rate[0] <= 0:
+      for column in ANALYSIS_COLUMNS:
+         df[column] = np.nan
+      return df
+
+   # scale relative to the smallest point, speedup from the throughput so
+   # thread/batch size sweeps and rank sweeps are treated alike
+   p = x / x[0]
+   speedup = rate / rate[0]
+   efficiency = speedup / p
+   with np.errstate(divide='ignore',invalid='ignore'):
+      karp_flatt = np.where(p > 1,(1. / speedup - 1. / p) / (1. - 1. / p),np.nan)
+
+   amdahl = fit_amdahl(p,speedup)
+   gustafson = fit_gustafson(p,speedup)
+   comm_coeffs,optimal_x = fit_comm_model(x,1. / rate)
+
+   df['Speedup'] = speedup
+   df['Parallel Efficiency'] = efficiency
+   df['Karp-Flatt Serial Fraction'] = karp_flatt
+   df['Amdahl Speedup Fit'] = amdahl_speedup(p,amdahl)
+   df['Gustafson Speedup Fit'] = gustafson_speedup(p,gustafson)
+   df['Comm Model Rate Fit'] = 1. / comm_model(x,comm_coeffs) if comm_coeffs is not None else np.nan
+   df['Amdahl Serial Fraction'] = amdahl
+   df['Gustafson Serial Fraction'] = gustafson
+   df['Comm Model Optimal Scale'] = optimal_x
+   df['Efficiency Knee'] = efficiency_knee(x,efficiency,knee_efficiency)
+   return df
+
+
+def fit_amdahl(p, speedup):
+   # 1/S = s + (1 - s)/p  ->  1/S - 1/p = s (1 - 1/p), least squares in s
+   b = 1. - 1. / p
+   a = 1. / speedup - 1. / p
+   if np.sum(b * b) == 0:
+      return np.nan
+   return float(np.clip(np.sum(a * b) / np.sum(b * b),0.,1.))
+
+
+def amdahl_speedup(p, serial_fraction):
+   return 1. / (serial_fraction + (1. - serial_fraction) / p)
+
+
+def fit_gustafson(p, speedup):
+   # S = p - s (p - 1)  ->  p - S = s (p - 1), least squares in s
+   b = p - 1.
+   if np.sum(b * b) == 0:
+      return np.nan
+   return float(np.clip(np.sum((p - speedup) * b) / np.sum(b * b),0.,1.))
+
+
+def gustafson_speedup(p, serial_fraction):
+   return p - serial_fraction * (p - 1.)
+
+
+def comm_model(x, coeffs):
+   # time per event = compute / x + serial + communication growing with log2(x)
+   a, b, c = coeffs
+   return a + b / x + c * np.log2(x)
+
+
+def fit_comm_model(x, time_per_event):
+   # least squares fit of comm_model, returns (coefficients, x minimising the time per event)
+   if len(np.unique(x)) < 3:
+      return None, np.nan
+   design = np.column_stack([np.ones_like(x),1. / x,np.log2(x)])
+   coeffs = np.linalg.lstsq(design,time_per_event,rcond=None)[0]
+   _, b, c = coeffs
+   # d/dx (b/x + c log2 x) = 0  ->  x = b ln2 / c
+   optimal_x = b * np.log(2.) / c if b > 0 and c > 0 else np.nan
+   return coeffs, float(optimal_x)
+
+
+def efficiency_knee(x, efficiency, threshold):
+   # first scale at which the parallel efficiency drops below threshold
+   below = np.nonzero(efficiency < threshold)[0]
+   return float(x[below[0]]) if len(below) else np.nan
+
+
+# two sided 95% Student t quantiles by degrees of freedom, the normal quantile beyond
+T_QUANTILES_95 = [12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+                  2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+                  2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042]
+REPLICA_STATS = ['Median', 'Min', 'Std', 'CI Low', 'CI High']
+
+
+def t_quantile_95(dof):
+   if dof < 1:
+      return np.nan
+   return T_QUANTILES_95[dof - 1] if dof <= len(T_QUANTILES_95) else 1.96
+
+
+def aggregate_replicas(df, stat_columns, point_key='Point'):
+   # one row per point_key: float columns are averaged over the replicas, other
+   # columns taken from the first replica, and every stat_columns entry gets
+   # "<column> <stat>" columns for REPLICA_STATS plus an "N Replicas" count
+   # stat columns are averaged even if they hold integers, e.g. "Bash Runtime" in seconds
+   df = df.astype({column: float for column in stat_columns if column in df and pd.api.types.is_numeric_dtype(df[column])})
+   groups = df.groupby(point_key,sort=True)
+   columns = [column for column in df.columns if column not in (point_key,'Replica')]
+   averaged = [column for column in columns if pd.api.types.is_float_dtype(df[column])]
+   out = groups[averaged].mean().join(groups[[column for column in columns if column not in averaged]].first())[columns]
+
+   n = groups.size()
+   t = n.map(lambda count: t_quantile_95(count - 1))
+   stats = {}
+   for column in stat_columns:
+      if column not in df:
+         continue
+      values = groups[column]
+      std = values.std()
+      half_width = t * std / np.sqrt(n)
+      stats[column + ' Median'] = values.median()
+      stats[column + ' Min'] = values.min()
+      stats[column + ' Std'] = std
+      stats[column + ' CI Low'] = out[column] - half_width
+      stats[column + ' CI High'] = out[column] + half_width
+   stats['N Replicas'] = n
+   return pd.concat([out,pd.DataFrame(stats)],axis=1).reset_index()
+
+
+def flag_high_variance(df, x_key=None, rate_key='Event Rate', max_cv=0.05):
+   # "<rate_key> CV" is the relative spread of the replicas, "High Variance" is
+   # set when it exceeds max_cv or when the rate changes by more than max_cv
+   # towards a neighbouring x_key scale but the confidence intervals overlap
+   if rate_key + ' Std' not in df:
+      return df
+   df = df.sort_values(by=x_key).reset_index(drop=True) if x_key is not None else df.copy()
+   rate = df[rate_key].to_numpy(dtype=float)
+   cv = df[rate_key + ' Std'].to_numpy(dtype=float) / rate
+   flag = cv > max_cv
+   if x_key is not None and len(df) > 1:
+      low = df[rate_key + ' CI Low'].to_numpy(dtype=float)
+      high = df[rate_key + ' CI High'].to_numpy(dtype=float)
+      overlap = (low[:-1] <= high[1:]) & (low[1:] <= high[:-1])
+      changed = np.abs(rate[1:] / rate[:-1] - 1.) > max_cv
+      inconclusive = overlap & changed
+      flag[:-1] |= inconclusive
+      flag[1:] |= inconclusive
+   df[rate_key + ' CV'] = cv
+   df['High Variance'] = flag
+   return df
@@ -0,0 +1,89 @@
+''' Persistent record of a campaign's sweep points.
+
+CampaignState keeps one row per sweep point (keyed by its working directory)
+in an SQLite file with the hash of its rendered script, the job that runs it,
+its current state and where its results are, plus a log of every state
+transition. The submit loop uses it to skip points that already finished,
+reattach to jobs that are still queued or running and only resubmit points
+that failed or whose script changed.
+'''
+import hashlib
+import sqlite3
+import time
+
+# point states, besides the scheduler's queued/running/exiting
+SUBMITTED = 'submitted'
+FINISHED = 'finished'
+FAILED = 'failed'
+
+SCHEMA = '''
+create table if not exists points (
+   job_working_path text primary key,
+   script_hash text not null,
+   job_id text,
+   state text not null,
+   exit_code integer,
+   submitted real,
+   updated real not null,
+   result_path text
+);
+create table if not exists transitions (
+   job_working_path text not null,
+   job_id text,
+   state text not null,
+   time real not null
+);
+'''
+
+
+def script_hash(script):
+   return hashlib.sha1(script.content.encode()).hexdigest()
+
+
+class CampaignState:
+
+   def __init__(self, filename):
+      self.filename = filename
+      self.db = sqlite3.connect(filename)
+      self.db.row_factory = sqlite3.Row
+      with self.db:
+         self.db.executescript(SCHEMA)
+
+   def close(self):
+      self.db.close()
+
+   def get(self, job_working_path):
+      row = self.db.execute('select * from points where job_working_path = ?',(job_working_path,)).fetchone()
+      return dict(row) if row is not None else None
+
+   def submitted(self, script, job_id):
+      now = time.time()
+      with self.db:
+         self.db.execute('insert or replace into points values (?,?,?,?,?,?,?,?)',
+                         (script.job_working_path,script_hash(script),str(job_id),SUBMITTED,None,now,now,None))
+         self.db.execute('insert into transitions values (?,?,?,?)',(script.job_working_path,str(job_id),SUBMITTED,now))
+
+   def update(self, job_working_path, state, exit_code=None, result_path=None):
+      # record a state change and the results file once known, returns False if the point was already in that state
+      row = self.get(job_working_path)
+      if row is None or (row['state'] == state and row['exit_code'] == exit_code):
+         return False
+      now = time.time()
+      with self.db:
+         self.db.execute('update points set state = ?, exit_code = ?, updated = ?, result_path = coalesce(?,result_path) where job_working_path = ?',
+                         (state,exit_code,now,result_path,job_working_path))
+         self.db.execute('insert into transitions values (?,?,?,?)',(job_working_path,row['job_id'],state,now))
+      return True
+
+   def classify(self, script):
+      ''' what to do with a point on (re)start: "done" if it finished with the
+          same script, "attach" if its job may still be in the queue, otherwise
+          "submit" (new, failed or changed script) '''
+      row = self.get(script.job_working_path)
+      if row is None or row['script_hash'] != script_hash(script):
+         return 'submit', None
+      if row['state'] == FINISHED:
+         return 'done', row['job_id']
+      if row['state'] == FAILED or not row['job_id']:
+         return 'submit', None
+      return 'attach', row['job_id']
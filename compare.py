@@ -0,0 +1,253 @@
+''' Compare extracted scaling campaigns, e.g. the same sweep run with two
+Kokkos/Pepper builds, and gate a build on its scaling not getting worse.
+
+   python compare.py -o cmp/ kokkos-3.7=/path/to/output_a kokkos-4.1=/path/to/output_b
+
+The first campaign is the baseline. The threads, ranks and sweep results of
+every campaign are extracted (unchanged runs are served from the extraction
+manifest), aligned with the baseline on the swept dimensions and compared
+metric by metric: the event rate, the parallel efficiency of threads and
+ranks scans, and every timer column, the EG-R recursion breakdown included.
+A change is significant when it exceeds both --threshold and --z times the
+combined relative standard deviation of the replicas (see the "repeats"
+config key). It is a regression when the event rate or the efficiency drops
+or when a timer that takes at least --min-share of the baseline total runtime
+grows. The comparison table is written to <output>comparison.csv with overlay
+plots next to it, and the exit status is 1 if any regression was found.
+'''
+import argparse
+import os
+import sys
+import numpy as np
+import pandas as pd
+from matplotlib.figure import Figure
+from analysis import REPLICA_STATS, scaling_analysis
+from plotter import (FigureSpec, SWEEP_PREFIX, error_bars, extraction_function,
+                     load_timer_columns, render_figures)
+
+# x axis of the one dimensional run types, sweeps align on their "Sweep <key>" columns
+CAMPAIGN_KINDS = {
+   'threads': ['Batch Size'],
+   'ranks': ['N Ranks'],
+   'sweep': None,
+}
+HIGHER_IS_BETTER = {'Event Rate','Parallel Efficiency'}
+REGRESSION = 'regression'
+MINOR_REGRESSION = 'minor regression'
+IMPROVEMENT = 'improvement'
+UNCHANGED = 'unchanged'
+
+
+def main():
+   parser = argparse.ArgumentParser(description='Compare scaling campaigns against a baseline and fail on performance regressions.')
+   parser.add_argument('campaigns', nargs='+', help='[label=]output_path of each campaign, the first one is the baseline')
+   parser.add_argument('-o', '--output-basename', required=True, help='output table and plot filename base, possibly including path.')
+   parser.add_argument('--threshold', type=float, default=0.05, help='smallest relative change that counts as significant')
+   parser.add_argument('--z', type=float, default=2., help='number of combined replica standard deviations a change must exceed')
+   parser.add_argument('--min-share', type=float, default=0.05, help='timers below this fraction of the baseline total runtime only report minor regressions')
+   parser.add_argument('--workers', type=int, default=None, help='number of processes used to extract runs and render figures, defaults to the number of cores')
+   parser.add_argument('--timer-columns', default=None, help='json file mapping extra Pepper timer tasks to result column names')
+   parser.add_argument('--no-cache', action='store_true', help='ignore and do not update the per-run extraction manifest',default=False)
+   args = parser.parse_args()
+
+   if len(args.campaigns) < 2:
+      parser.error('need a baseline and at least one campaign to compare')
+   fn_base = args.output_basename
+   if not fn_base.endswith('/') and not fn_base.endswith('.') and not fn_base.endswith('_'):
+      fn_base = fn_base + '.'
+   if os.path.dirname(fn_base):
+      os.makedirs(os.path.dirname(fn_base),exist_ok=True)
+
+   timer_columns = load_timer_columns(args.timer_columns)
+   campaigns = [parse_campaign(campaign) for campaign in args.campaigns]
+   results = {label: load_campaign(path,args.workers,not args.no_cache,timer_columns) for label,path in campaigns}
+   labels = [label for label,_ in campaigns]
+   if len(set(labels)) != len(labels):
+      parser.error('campaign labels must be unique: ' + ', '.join(labels))
+
+   tables = []
+   figures = []
+   baseline = labels[0]
+   for kind,x_keys in CAMPAIGN_KINDS.items():
+      if kind not in results[baseline]:
+         continue
+      base_df = results[baseline][kind]
+      keys = x_keys or sorted(column for column in base_df.columns if column.startswith(SWEEP_PREFIX))
+      if not keys:
+         print(f'{baseline} {kind} results have no swept dimensions to align on')
+         continue
+      for label in labels[1:]:
+         if kind not in results[label]:
+            print(f'{label} has no {kind} results to compare')
+            continue
+         table = compare_results(base_df,results[label][kind],keys,metric_columns(base_df,timer_columns),
+                                 args.threshold,args.z,args.min_share)
+         table.insert(0,'Kind',kind)
+         table.insert(1,'Campaign',label)
+         tables.append(table)
+         figures.append(FigureSpec(plot_timer_deltas,f'{fn_base}{kind}_{file_label(label)}_timer_deltas.png',
+                                   dict(table=table,title=f'{kind}: {label} vs {baseline}')))
+
+      combined = pd.concat([results[label][kind].assign(Campaign=label) for label in labels if kind in results[label]],ignore_index=True)
+      if x_keys:
+         figures.append(FigureSpec(plot_overlay,f'{fn_base}{kind}_event_rate.png',
+                                   dict(df=combined,x_key=x_keys[0],y_key='Event Rate',baseline=baseline,keys=keys)))
+      else:
+         figures.append(FigureSpec(plot_parity,f'{fn_base}{kind}_event_rate.png',
+                                   dict(df=combined,y_key='Event Rate',baseline=baseline,keys=keys)))
+
+   if not tables:
+      print('no results in common with the baseline')
+      return 1
+   table = pd.concat(tables,ignore_index=True)
+   table.to_csv(fn_base + 'comparison.csv',index=False)
+   render_figures(figures,fn_base + 'figure_hashes.json',args.workers)
+
+   regressions = table[table['Status'] == REGRESSION]
+   for (kind,label),group in table.groupby(['Kind','Campaign'],sort=False):
+      counts = group['Status'].value_counts()
+      print(f'{kind} {label} vs {baseline}: ' + ', '.join(f'{counts.get(status,0)} {status}'
+            for status in (REGRESSION,MINOR_REGRESSION,IMPROVEMENT,UNCHANGED)))
+   for _,row in regressions.iterrows():
+      print('REGRESSION %s %s %s %s: %.4g -> %.4g (%+.1f%%, limit %.1f%%)' % (
+         row['Kind'],row['Campaign'],row['Point'],row['Metric'],row['Baseline'],row['Candidate'],100 * row['Delta'],100 * row['Limit']))
+   return 1 if len(regressions) else 0
+
+
+def parse_campaign(campaign):
+   # "label=path" or "path", labelled by the directory name
+   label,sep,path = campaign.partition('=')
+   if not sep:
+      path = campaign
+      label = os.path.basename(os.path.normpath(campaign))
+   return label,path
+
+
+def file_label(label):
+   return ''.join(c if c.isalnum() or c in '.-' else '_' for c in label)
+
+
+def load_campaign(path, workers=None, use_cache=True, timer_columns=None):
+   # {kind: DataFrame} of every run type the campaign has results for
+   results = {}
+   for kind,x_keys in CAMPAIGN_KINDS.items():
+      base_path = os.path.join(path,kind)
+      if os.path.isdir(base_path):
+         df = extraction_function(base_path,workers,use_cache,timer_columns)
+         results[kind] = scaling_analysis(df,x_keys[0]) if x_keys else df
+   return results
+
+
+def metric_columns(df, timer_columns):
+   # the event rate and parallel efficiency followed by every timer column present,
+   # unmapped "Timer <task>" ones included but not the "<timer> <stat>" replica statistics
+   stats = {f'{column} {stat}' for column in df.columns for stat in REPLICA_STATS}
+   timers = [column for column in df.columns
+             if (column in timer_columns.values() or column.startswith('Timer ')) and column not in stats]
+   return [column for column in ('Event Rate','Parallel Efficiency') if column in df] + timers
+
+
+def relative_std(df, metric, suffix):
+   std_column = f'{metric} Std{suffix}'
+   if std_column not in df:
+      return pd.Series(0.,index=df.index)
+   return (df[std_column] / df[metric + suffix]).fillna(0.)
+
+
+def compare_results(baseline, candidate, keys, metrics, threshold=0.05, z=2., min_share=0.05):
+   ''' One row per aligned point and metric with the baseline and candidate
+       values, the relative change, the replica noise and the limit the change
+       has to exceed, and its status. '''
+   merged = baseline.merge(candidate,on=keys,suffixes=(' baseline',' candidate'))
+   point = merged[keys].astype(str).apply(lambda values: ', '.join(f'{key}={value}' for key,value in zip(keys,values)),axis=1)
+   total = merged['Total Runtime baseline'] if 'Total Runtime baseline' in merged else None
+   tables = []
+   for metric in metrics:
+      if metric + ' candidate' not in merged:
+         continue
+      base = merged[metric + ' baseline']
+      cand = merged[metric + ' candidate']
+      delta = cand / base - 1.
+      noise = np.sqrt(relative_std(merged,metric,' baseline') ** 2 + relative_std(merged,metric,' candidate') ** 2)
+      limit = np.maximum(threshold,z * noise)
+      worse = -delta if metric in HIGHER_IS_BETTER else delta
+      status = np.where(worse > limit,REGRESSION,np.where(-worse > limit,IMPROVEMENT,UNCHANGED))
+      if metric not in HIGHER_IS_BETTER and total is not None:
+         # small timers are too noisy to gate a build on
+         status = np.where((status == REGRESSION) & (base / total < min_share),MINOR_REGRESSION,status)
+      table = merged[keys].copy()
+      table['Point'] = point
+      table['Metric'] = metric
+      table['Baseline'] = base
+      table['Candidate'] = cand
+      table['Delta'] = delta
+      table['Noise'] = noise
+      table['Limit'] = limit
+      table['Status'] = np.where(delta.isna(),UNCHANGED,status)
+      tables.append(table)
+   return pd.concat(tables,ignore_index=True)
+
+
+def plot_overlay(df, x_key, y_key, baseline, keys, output_filename):
+   # every campaign on a log-log plot with replica error bars, and its ratio to the baseline below
+   fig = Figure(dpi=240)
+   ax = fig.subplots(2, 1, sharex=True, gridspec_kw={'height_ratios': [3, 1], 'hspace': 0})
+   base = df[df['Campaign'] == baseline].set_index(keys)[y_key]
+   for label,campaign in df.groupby('Campaign',sort=False):
+      campaign = campaign.sort_values(by=x_key)
+      ax[0].errorbar(campaign[x_key], campaign[y_key], yerr=error_bars(campaign, y_key), fmt='o-', capsize=3, label=label)
+      ratio = campaign[y_key].to_numpy() / base.reindex(campaign.set_index(keys).index).to_numpy()
+      ax[1].plot(campaign[x_key], ratio, 'o-')
+   ax[0].set_xscale('log')
+   ax[0].set_yscale('log')
+   ax[0].set_ylabel(y_key)
+   ax[0].grid(which='major', linestyle='-', alpha=0.7)
+   ax[0].legend(fontsize='small')
+   ax[1].axhline(1., color='k', alpha=0.3)
+   ax[1].set_xlabel(x_key)
+   ax[1].set_ylabel('ratio to ' + baseline, fontsize='small')
+   ax[1].grid(which='major', linestyle='-', alpha=0.7)
+   fig.tight_layout()
+   fig.savefig(output_filename)
+
+
+def plot_parity(df, y_key, baseline, keys, output_filename):
+   # candidate against baseline value for every aligned sweep point
+   fig = Figure(dpi=240)
+   ax = fig.add_subplot()
+   base = df[df['Campaign'] == baseline].set_index(keys)[y_key]
+   for label,campaign in df.groupby('Campaign',sort=False):
+      if label == baseline:
+         continue
+      campaign = campaign.set_index(keys)[y_key]
+      common = base.index.intersection(campaign.index)
+      ax.loglog(base.loc[common], campaign.loc[common], 'o', label=label)
+   limits = [base.min(), base.max()]
+   ax.loglog(limits, limits, 'k-', alpha=0.3, label=baseline)
+   ax.set_xlabel(f'{y_key} ({baseline})')
+   ax.set_ylabel(y_key)
+   ax.grid(which='major', linestyle='-', alpha=0.7)
+   ax.legend(fontsize='small')
+   fig.tight_layout()
+   fig.savefig(output_filename)
+
+
+def plot_timer_deltas(table, title, output_filename):
+   # median relative change of every metric over the aligned points, regressions in red
+   summary = table.groupby('Metric',sort=False).agg(delta=('Delta','median'),
+                                                    regression=('Status',lambda status: (status == REGRESSION).any()))
+   fig = Figure(figsize=(6, 0.3 * len(summary) + 1.5), dpi=240)
+   ax = fig.add_subplot()
+   colors = ['r' if regression else 'tab:blue' for regression in summary['regression']]
+   ax.barh(summary.index, 100 * summary['delta'], color=colors)
+   ax.axvline(0., color='k', alpha=0.5)
+   ax.invert_yaxis()
+   ax.set_xlabel('median change [%]')
+   ax.set_title(title)
+   ax.grid(axis='x', linestyle=':', alpha=0.5)
+   fig.tight_layout()
+   fig.savefig(output_filename)
+
+
+if __name__ == "__main__":
+   sys.exit(main())
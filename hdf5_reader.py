@@ -0,0 +1,86 @@
+''' Read-only access to Pepper event_data.hdf5 files.
+
+EventFile opens the file read-only without HDF5 file locking (which is slow or
+unsupported on Lustre), with a chunk cache sized for streaming, and closes it
+deterministically when used as a context manager:
+
+   with EventFile(filename) as events:
+      xs_mean, xs_sigma = events.read('generatedResult',slice(0,2))
+      stats = events.stream_stats()
+'''
+import h5py as hp
+import numpy as np
+
+# chunk cache per open dataset, large enough to hold a few chunks of the event table
+CHUNK_CACHE_BYTES = 16 * 1024 * 1024
+CHUNK_CACHE_SLOTS = 1009
+# rows read at once when a dataset is not chunked
+STREAM_ROWS = 1 << 18
+
+
+class EventFile:
+
+   def __init__(self, filename, driver=None, rdcc_nbytes=CHUNK_CACHE_BYTES):
+      self.filename = filename
+      self.driver = driver
+      self.rdcc_nbytes = rdcc_nbytes
+      self.file = None
+
+   def __enter__(self):
+      self.file = hp.File(self.filename,'r',driver=self.driver,locking=False,
+                          rdcc_nbytes=self.rdcc_nbytes,rdcc_nslots=CHUNK_CACHE_SLOTS)
+      return self
+
+   def __exit__(self, exc_type, exc_value, traceback):
+      self.close()
+      return False
+
+   def close(self):
+      if self.file is not None:
+         self.file.close()
+         self.file = None
+
+   def read(self, name, selection=()):
+      # read only the selected part of a dataset, e.g. read('generatedResult',slice(0,2))
+      return self.file[name][selection]
+
+   def attribute(self, name, attr):
+      return self.file[name].attrs[attr]
+
+   def column_index(self, name, column):
+      # LHEH5 style tables name their columns in a "properties" attribute
+      properties = self.file[name].attrs.get('properties')
+      if properties is None:
+         raise KeyError(f'{name} has no properties attribute to find column {column}')
+      names = [p.decode() if isinstance(p,bytes) else str(p) for p in properties]
+      return names.index(column)
+
+   def iter_rows(self, name, columns=None):
+      # yield blocks of rows following the dataset's chunking so each chunk is read once
+      dataset = self.file[name]
+      step = dataset.chunks[0] * max(STREAM_ROWS // dataset.chunks[0],1) if dataset.chunks else STREAM_ROWS
+      for start in range(0,dataset.shape[0],step):
+         if columns is None:
+            yield dataset[start:start + step]
+         else:
+            yield dataset[start:start + step,columns]
+
+   def stream_stats(self, name='events', weight_column='weight'):
+      # event count and weight sums over a table, read block by block
+      n_events = 0
+      n_nonzero = 0
+      weight_sum = 0.
+      weight_sum2 = 0.
+      column = self.column_index(name,weight_column)
+      for weights in self.iter_rows(name,column):
+         weights = np.asarray(weights,dtype=np.float64)
+         n_events += len(weights)
+         n_nonzero += int(np.count_nonzero(weights))
+         weight_sum += float(weights.sum())
+         weight_sum2 += float(np.dot(weights,weights))
+      return {
+         'N Events': n_events,
+         'N Nonzero Weights': n_nonzero,
+         'Weight Sum': weight_sum,
+         'Weight Sum2': weight_sum2,
+      }
@@ -1,61 +1,366 @@
 import json
-from scheduler import PBS  # Import other schedulers as you implement them
+from scheduler import PBS, Local, SLURM  # Import other schedulers as you implement them
+from monitor import CampaignMonitor
+import campaign_state
+from adaptive import AdaptiveRefiner
 import logging
 import argparse
 import os
 import time
+import collections
+import itertools
+import glob
+import functools
+import re
 logger = logging.getLogger(__name__)
 
-def get_scheduler(name):
+def get_scheduler(name, poll_interval=30, options=None):
     if name == "PBS":
-        return PBS()
+        return PBS(poll_interval)
+    elif name == "local":
+        # run the job scripts on this node, options from the config "local" block
+        return Local(poll_interval, **(options or {}))
+    elif name == "SLURM":
+        return SLURM(poll_interval)
     # Add more schedulers as needed
-    # elif name == "SLURM":
-    #     return SLURM()
     else:
         raise ValueError(f"Unsupported scheduler: {name}")
 
-def run_with_threads(scheduler, config, no_sub=False, single_queue=False):
-    for threads in config["range"]:
-        ranks = config['fixed_value']
-        job_working_path = os.path.join(config['output_path'],'threads', f'{threads:06d}-threads_{ranks:05d}-ranks')
-        job_id = scheduler.submit(config,threads,ranks,job_working_path,no_sub)
-
-        if single_queue and not no_sub:
-            logger.info('waiting for job %s with %d ranks %d threads %d ranks\njob path: %s',job_id,ranks,threads,ranks,job_working_path)
-            while scheduler.status(job_id):
-                logger.debug('waiting for job %s',job_id)
-                time.sleep(30)  # Check every 30 seconds
-        else:
-            logger.info('submitted job %s with  %d ranks %d threads %d ranks\njob path: %s',job_id,ranks,threads,ranks,job_working_path)
+POLL_INTERVAL = 30  # seconds between job status checks
+DEFAULT_SEED = 12345
+REPLICA_DIRNAME = 'replica_{:03d}'
+# the end of a job log searched for the "[$SECONDS] pepper done" marker
+LOG_TAIL_SIZE = 64 * 1024
+LOG_DONE_RE = re.compile(rb'^\[\d+\] pepper done\s*$',re.MULTILINE)
+
+
+def run_with_threads(scheduler, config, no_sub=False, max_in_flight=0, poll_interval=POLL_INTERVAL, monitor=None, state=None):
+    run_range(scheduler, config, threads_point, no_sub, max_in_flight, poll_interval, monitor, state)
+
+
+def run_with_ranks(scheduler, config, no_sub=False, max_in_flight=0, poll_interval=POLL_INTERVAL, monitor=None, state=None):
+    run_range(scheduler, config, ranks_point, no_sub, max_in_flight, poll_interval, monitor, state)
+
+
+def threads_point(config, threads):
+    ranks = config['fixed_value']
+    job_working_path = os.path.join(config['output_path'],'threads', f'{threads:06d}-threads_{ranks:05d}-ranks')
+    return (threads,ranks,job_working_path,{})
+
+
+def ranks_point(config, ranks):
+    threads = config["fixed_value"]
+    job_working_path = os.path.join(config['output_path'],'ranks', f'{threads:06d}-threads_{ranks:05d}-ranks')
+    return (threads,ranks,job_working_path,{})
+
+
+def run_range(scheduler, config, make_point, no_sub=False, max_in_flight=0, poll_interval=POLL_INTERVAL, monitor=None, state=None):
+    # every value of config["range"], or with an "adaptive" block only the values the refiner picks
+    refiner = None
+    if 'adaptive' in config:
+        refiner = AdaptiveRefiner(scheduler, config, functools.partial(make_point,config))
+        points = refiner.start()
+        if no_sub:
+            logger.warning('adaptive sweep: --no-sub only renders the initial points, refinement needs finished jobs')
+            refiner = None
+    else:
+        points = [make_point(config,x) for x in config["range"]]
+    run_pipeline(scheduler, config, points, no_sub, max_in_flight, poll_interval, monitor, state, refiner)
+
+
+def run_sweep(scheduler, config, no_sub=False, max_in_flight=0, poll_interval=POLL_INTERVAL, monitor=None, state=None):
+    sweep_params = sweep_points(config)
+    # options a point does not set keep their script_template_opts value
+    defaults = config['script_template_opts']
+    keys = list(dict.fromkeys(key for params in sweep_params for key in params))
+    sweep_params = [{key: params.get(key,defaults.get(key)) for key in keys} for params in sweep_params]
+    # dimensions that differ between points name the working directories and become result columns
+    dimensions = [key for key in keys if len(set(str(params[key]) for params in sweep_params)) > 1]
+    weak_scaled = list(config['sweep'].get('weak_scaling',{}))
+    dirnames = {}
+    for params in sweep_params:
+        dirname = f"{params['threads']:06d}-threads_{params['ranks']:05d}-ranks"
+        for key in dimensions:
+            if key not in ('threads','ranks') and key not in weak_scaled:
+                dirname += '_' + key + '-' + re.sub(r'[^A-Za-z0-9.+-]+','_',str(params[key]))
+        if dirname in dirnames:
+            raise ValueError(f'sweep points {dirnames[dirname]} and {params} share the working directory {dirname}')
+        dirnames[dirname] = params
+    points = []
+    for dirname, params in dirnames.items():
+        threads = params['threads']
+        ranks = params['ranks']
+        overrides = {key: value for key, value in params.items() if key not in ('threads','ranks') and value is not None}
+        job_working_path = os.path.join(config['output_path'],'sweep',dirname)
+        os.makedirs(job_working_path,exist_ok=True)
+        with open(os.path.join(job_working_path,'sweep_point.json'),'w') as f:
+            json.dump({'dimensions': {key: params[key] for key in dimensions if key not in weak_scaled},
+                       'weak_scaled': {key: params[key] for key in weak_scaled}},f,indent=3)
+        points.append((threads,ranks,job_working_path,overrides))
+    run_pipeline(scheduler, config, points, no_sub, max_in_flight, poll_interval, monitor, state)
+
+
+def sweep_points(config):
+    ''' Expand config["sweep"] into a list of {template option: value} dicts.
+        "mode": "product" (default) takes the cartesian product of the
+        "dimensions" lists, "list" uses the explicit "points" list. "fixed"
+        values fill in options a point does not set, and "weak_scaling" rules
+        {"n_batches": {"scale_by": "ranks", "reference": 4}} scale an option
+        by point["ranks"] / reference to hold the work per rank constant. '''
+    sweep = config['sweep']
+    mode = sweep.get('mode','product')
+    if mode == 'product':
+        dimensions = sweep['dimensions']
+        keys = list(dimensions)
+        points = [dict(zip(keys,values)) for values in itertools.product(*(dimensions[key] for key in keys))]
+    elif mode == 'list':
+        points = [dict(point) for point in sweep['points']]
+    else:
+        raise ValueError(f"Unsupported sweep mode: {mode}")
+
+    for point in points:
+        for key, value in sweep.get('fixed',{}).items():
+            point.setdefault(key,value)
+        for key, rule in sweep.get('weak_scaling',{}).items():
+            value = point.get(key,config['script_template_opts'].get(key))
+            point[key] = int(round(value * point[rule['scale_by']] / rule.get('reference',1)))
+        if 'threads' not in point or 'ranks' not in point:
+            raise ValueError(f"sweep point {point} needs both 'threads' and 'ranks'")
+    return points
+
+
+def run_pipeline(scheduler, config, points, no_sub=False, max_in_flight=0, poll_interval=POLL_INTERVAL, monitor=None, state=None, refiner=None):
+    ''' Submit (threads, ranks, job_working_path, overrides) points keeping at most max_in_flight
+        jobs queued or running, the next job goes in as soon as any job leaves
+        the queue. max_in_flight <= 0 submits everything at once. With
+        config "bundle_size" > 1 that many points are packed into each job,
+        with config "array_jobs" points requesting the same nodes and walltime
+        are submitted together as array jobs of up to "array_max_size" elements.
+        All scripts are rendered and validated before the first submission.
+        A CampaignMonitor follows the progress of every in-flight job, a
+        CampaignState records every point and lets a rerun resume. An
+        AdaptiveRefiner is handed every finished job and its new points are
+        queued behind the pending ones. '''
+    scripts = scheduler.render_all(config, replica_points(config, points))
+    in_flight = {}
+    if state is not None and not no_sub:
+        scripts = resume_campaign(scheduler, state, scripts, in_flight, monitor)
+    bundle_size = max(config.get("bundle_size",1),1)
+    array_jobs = config.get("array_jobs",False)
+    if array_jobs and bundle_size > 1:
+        raise ValueError('array_jobs cannot be combined with bundle_size > 1')
+    if array_jobs:
+        # points with the same resources next to each other, so they share arrays
+        scripts = sorted(scripts,key=array_key)
+    pending = collections.deque(make_bundles(scripts,bundle_size))
+    while pending or in_flight:
+        while pending and (max_in_flight <= 0 or len(in_flight) < max_in_flight):
+            if array_jobs:
+                # an array counts one in-flight slot per element
+                limit = config.get("array_max_size") or len(pending)
+                if max_in_flight > 0:
+                    limit = min(limit,max_in_flight - len(in_flight))
+                jobs = submit_array(scheduler, config, take_array(pending,limit), no_sub)
+            else:
+                bundle = pending.popleft()
+                jobs = [(submit_bundle(scheduler, config, bundle, no_sub),bundle)]
+            for job_id, bundle in jobs:
+                if no_sub:
+                    continue
+                if not job_id:
+                    logger.error('submission failed for %s',describe_bundle(bundle))
+                    continue
+                if state is not None:
+                    for script in bundle:
+                        state.submitted(script,job_id)
+                if max_in_flight <= 0 and monitor is None and refiner is None and not scheduler.DRIVEN_BY_POLLING:
+                    continue
+                in_flight[job_id] = bundle
+                if monitor is not None:
+                    monitor.add(job_id,bundle)
+
+        if not in_flight:
+            continue
+        logger.debug('waiting for %d jobs, %d jobs pending',len(in_flight),len(pending))
+        time.sleep(poll_interval)
+        statuses = scheduler.status_many(list(in_flight))
+        if monitor is not None:
+            monitor.update(statuses)
+        for job_id, status in statuses.items():
+            if status.active:
+                if state is not None:
+                    for script in in_flight[job_id]:
+                        state.update(script.job_working_path,status.state)
+                continue
+            bundle = in_flight.pop(job_id)
+            if monitor is not None:
+                monitor.remove(job_id)
+            if state is not None:
+                record_finished(state,bundle,status)
+            logger.info('job %s with %s finished with exit code %s',job_id,describe_bundle(bundle),status.exit_code)
+            if refiner is not None:
+                new_points = refiner.finished(bundle)
+                if new_points:
+                    new_scripts = scheduler.render_all(config, replica_points(config, new_points))
+                    if state is not None:
+                        new_scripts = resume_campaign(scheduler, state, new_scripts, in_flight, monitor)
+                    pending.extend(make_bundles(new_scripts,bundle_size))
+
+
+def replica_points(config, points):
+    ''' Expand every point into config "repeats" replicas, each with its own
+        working subdirectory and seed (the point's seed plus the replica
+        number). With a single repeat the point keeps its directory. '''
+    repeats = max(config.get("repeats",1),1)
+    base_seed = config['script_template_opts'].get('seed',DEFAULT_SEED)
+    replicas = []
+    for threads,ranks,job_working_path,overrides in points:
+        seed = overrides.get('seed',base_seed)
+        for replica in range(repeats):
+            path = os.path.join(job_working_path,REPLICA_DIRNAME.format(replica)) if repeats > 1 else job_working_path
+            replicas.append((threads,ranks,path,dict(overrides,seed=seed + replica)))
+    return replicas
 
 
-def run_with_ranks(scheduler, config, no_sub=False, single_queue=False):
-    for ranks in config["range"]:
-        threads = config["fixed_value"]
-        job_working_path = os.path.join(config['output_path'],'ranks', f'{threads:06d}-threads_{ranks:05d}-ranks')
-        job_id = scheduler.submit(config,threads,ranks,job_working_path,no_sub)
+def make_bundles(scripts, bundle_size):
+    return [scripts[i:i + bundle_size] for i in range(0,len(scripts),bundle_size)]
 
-        if single_queue and not no_sub:
-            logger.info('waiting for job %s with %d ranks %d threads %d ranks\njob path: %s',job_id,ranks,threads,ranks,job_working_path)
-            while scheduler.status(job_id):
-                logger.debug('waiting for job %s',job_id)
-                time.sleep(30)  # Check every 30 seconds
+
+def resume_campaign(scheduler, state, scripts, in_flight, monitor=None):
+    ''' Skip points that already finished with the same script, put jobs that
+        are still queued or running back into in_flight and return the scripts
+        that need to be (re)submitted. '''
+    to_submit = []
+    attach = {}
+    for script in scripts:
+        action, job_id = state.classify(script)
+        if action == 'done':
+            logger.info('skipping finished point %s (job %s)',script.job_working_path,job_id)
+        elif action == 'attach':
+            attach.setdefault(job_id,[]).append(script)
+        else:
+            to_submit.append(script)
+
+    statuses = scheduler.status_many(list(attach)) if attach else {}
+    for job_id, bundle in attach.items():
+        status = statuses[job_id]
+        if status.active:
+            logger.info('reattached to job %s with %s',job_id,describe_bundle(bundle))
+            in_flight[job_id] = bundle
+            if monitor is not None:
+                monitor.add(job_id,bundle)
+        elif not record_finished(state,bundle,status):
+            to_submit.extend(bundle)
         else:
-            logger.info('submitted job %s with  %d ranks %d threads %d ranks\njob path: %s',job_id,ranks,threads,ranks,job_working_path)
+            logger.info('job %s with %s finished while detached',job_id,describe_bundle(bundle))
+    return to_submit
+
+
+def record_finished(state, bundle, status):
+    # jobs that left the history without an exit code count as finished if their points left results
+    succeeded = True
+    for script in bundle:
+        result_path = find_results(script)
+        point_succeeded = status.exit_code == 0 or (status.exit_code is None and result_path is not None)
+        state.update(script.job_working_path,campaign_state.FINISHED if point_succeeded else campaign_state.FAILED,
+                     status.exit_code,result_path)
+        succeeded = succeeded and point_succeeded
+    if not succeeded:
+        logger.warning('job %s failed with exit code %s, it will be resubmitted on the next run',status.job_id,status.exit_code)
+    return succeeded
+
+
+def find_results(script):
+    # the point's timers.csv, else its log if pepper got to the end, None if it left neither
+    timers = sorted(glob.glob(os.path.join(script.job_working_path,'pepper_diagnostics','*','timers.csv')))
+    if timers:
+        return timers[0]
+    logs = sorted(glob.glob(os.path.join(script.job_working_path,script.opts['job_name'] + '.o*')),key=os.path.getmtime)
+    if logs:
+        with open(logs[-1],'rb') as f:
+            f.seek(max(os.fstat(f.fileno()).st_size - LOG_TAIL_SIZE,0))
+            if LOG_DONE_RE.search(f.read()):
+                return logs[-1]
+    return None
+
+
+def submit_bundle(scheduler, config, bundle, no_sub=False):
+    # submit a list of rendered scripts as a single job, or as a plain job if it only holds one
+    if len(bundle) == 1:
+        job_id = scheduler.submit_rendered(bundle[0],no_sub)
+    else:
+        bundle_path = os.path.join(config['output_path'],'bundles',config['run_type'],job_dirname(bundle))
+        job_id = scheduler.submit_bundle(config,bundle,bundle_path,no_sub)
+    logger.info('submitted job %s with %s',job_id,describe_bundle(bundle))
+    return job_id
+
 
-def main(config_file,no_sub=False, single_queue=False):
+def array_key(script):
+    # points can share an array job if they request the same nodes and walltime
+    return (script.opts['num_nodes'],str(script.opts['walltime']))
+
+
+def take_array(pending, limit):
+    # remove and return up to limit pending single-script bundles with the resources of the first one
+    key = array_key(pending[0][0])
+    taken = []
+    for bundle in list(pending):
+        if len(taken) == limit:
+            break
+        if array_key(bundle[0]) == key:
+            pending.remove(bundle)
+            taken.append(bundle[0])
+    return taken
+
+
+def submit_array(scheduler, config, scripts, no_sub=False):
+    # submit rendered scripts as one array job, returns a (job_id, [script]) pair per element
+    if len(scripts) == 1:
+        return [(submit_bundle(scheduler, config, scripts, no_sub),scripts)]
+    array_path = os.path.join(config['output_path'],'arrays',config['run_type'],job_dirname(scripts))
+    job_ids = scheduler.submit_array(config,scripts,array_path,no_sub)
+    logger.info('submitted array job with elements %s to %s: %s',job_ids[0],job_ids[-1],describe_bundle(scripts))
+    return [(job_id,[script]) for job_id,script in zip(job_ids,scripts)]
+
+
+def job_dirname(scripts):
+    # "<first point>_x<n>", replicas named after their point
+    first_path = scripts[0].job_working_path
+    name = os.path.basename(first_path)
+    if re.fullmatch(REPLICA_DIRNAME.replace('{:03d}',r'\d+'),name):
+        name = os.path.basename(os.path.dirname(first_path)) + '_' + name
+    return f'{name}_x{len(scripts)}'
+
+
+def describe_bundle(bundle):
+    return '; '.join(f'{script.threads} threads {script.ranks} ranks in {script.job_working_path}' for script in bundle)
+
+
+def main(config_file,no_sub=False, max_in_flight=None, poll_interval=POLL_INTERVAL, monitor=False, state_db=None):
     with open(config_file, 'r') as f:
         config = json.load(f)
 
-    scheduler = get_scheduler(config["scheduler"])
+    scheduler = get_scheduler(config["scheduler"], poll_interval, config.get("local"))
+    if max_in_flight is None:
+        max_in_flight = config.get("max_in_flight",0)
+    campaign_monitor = CampaignMonitor(config, scheduler) if monitor else None
+    state = None
+    if not no_sub:
+        if state_db is None:
+            state_db = os.path.join(config['output_path'],'campaign_state.sqlite')
+        os.makedirs(os.path.dirname(os.path.abspath(state_db)),exist_ok=True)
+        state = campaign_state.CampaignState(state_db)
 
     if config["run_type"] == "threads":
-        run_with_threads(scheduler, config, no_sub, single_queue)
+        run_with_threads(scheduler, config, no_sub, max_in_flight, poll_interval, campaign_monitor, state)
     elif config["run_type"] == "ranks":
-        run_with_ranks(scheduler, config, no_sub, single_queue)
+        run_with_ranks(scheduler, config, no_sub, max_in_flight, poll_interval, campaign_monitor, state)
+    elif config["run_type"] == "sweep":
+        run_sweep(scheduler, config, no_sub, max_in_flight, poll_interval, campaign_monitor, state)
     else:
         print(f"Invalid run_type: {config['run_type']}")
+    if state is not None:
+        state.close()
 
 if __name__ == "__main__":
    ''' Scaler framework for running tests. '''
@@ -67,7 +372,11 @@ if __name__ == "__main__":
    parser.add_argument('-c','--config',help='Input config file in json format',required=True)
 
    parser.add_argument('--no-sub', default=False, action='store_true', help="For debugging, disable subprocess calls")
-   parser.add_argument('--single-queue', default=False, action='store_true', help="Ensure only one job is in the queue at a time")
+   parser.add_argument('--single-queue', default=False, action='store_true', help="Ensure only one job is in the queue at a time, same as --max-in-flight 1")
+   parser.add_argument('--max-in-flight', default=None, type=int, help="Maximum number of jobs queued or running at once, the next point is submitted when a slot frees up (default: config 'max_in_flight', 0 = no limit)")
+   parser.add_argument('--monitor', default=False, action='store_true', help="Follow running jobs' logs and timers, report event rates and flag stalled or slow runs (see config 'monitor')")
+   parser.add_argument('--state-db', default=None, help="SQLite file recording submitted points, rerunning skips finished points and reattaches to queued jobs (default: <output_path>/campaign_state.sqlite)")
+   parser.add_argument('--poll-interval', default=POLL_INTERVAL, type=int, help="Seconds between job status checks")
 
 
    parser.add_argument('--debug', default=False, action='store_true', help="Set Logger to DEBUG")
@@ -88,4 +397,8 @@ if __name__ == "__main__":
                        datefmt=logging_datefmt,
                        filename=args.logfilename)
    
-   main(args.config,args.no_sub, single_queue=args.single_queue)
+   max_in_flight = args.max_in_flight
+   if args.single_queue:
+      max_in_flight = 1
+
+   main(args.config,args.no_sub, max_in_flight=max_in_flight, poll_interval=args.poll_interval, monitor=args.monitor, state_db=args.state_db)
@@ -0,0 +1,184 @@
+''' Live progress monitor for running sweep jobs.
+
+CampaignMonitor follows the working directory of every job the submit loop
+tracks. It tails the "<job_name>.o*" log and pepper_diagnostics/*/timers.csv,
+keeping byte offsets so nothing is read twice, estimates an event rate from
+progress lines in the log and flags runs that stalled (no output for
+stall_seconds) or that are projected to run past their walltime.
+
+Options come from the config "monitor" block:
+   progress_regex   regex with an "events" group counting generated events
+   stall_seconds    seconds without new output before a run counts as stalled
+   delete_flagged   qdel stalled or too slow runs instead of only reporting them
+'''
+import glob
+import logging
+import os
+import re
+import time
+from scheduler.sched_base import RUNNING, parse_walltime
+logger = logging.getLogger(__name__)
+
+DEFAULT_PROGRESS_REGEX = r'(?P<events>\d+)\s+events'
+DEFAULT_STALL_SECONDS = 900
+
+
+class FileTail:
+   ''' Returns the complete lines appended to a file since the last read. '''
+
+   def __init__(self, filename):
+      self.filename = filename
+      self.offset = 0
+      self.remainder = b''
+
+   def read_lines(self):
+      try:
+         with open(self.filename,'rb') as f:
+            f.seek(self.offset)
+            data = f.read()
+      except OSError:
+         return []
+      self.offset += len(data)
+      data = self.remainder + data
+      end = data.rfind(b'\n') + 1
+      self.remainder = data[end:]
+      return data[:end].decode('utf-8','replace').splitlines()
+
+
+class RunMonitor:
+   ''' Progress of one sweep point, fed by tailing its log and timers. '''
+
+   def __init__(self, job_id, script, progress_re, stall_seconds, bundled=False):
+      self.job_id = job_id
+      # points of a bundle start when their log appears, not when the job does
+      self.bundled = bundled
+      self.script = script
+      self.progress_re = progress_re
+      self.stall_seconds = stall_seconds
+      self.walltime = parse_walltime(script.opts.get('walltime'))
+      self.total_events = script.opts['threads'] * script.opts.get('n_batches',1)
+      self.log = None
+      self.timers = None
+      self.start_time = None
+      self.last_output = None
+      self.events = None
+      self.event_time = None
+      self.rate = None
+      self.timer_tasks = 0
+      self.flag = None
+
+   @property
+   def started(self):
+      return self.log is not None
+
+   def update(self, status, now):
+      if self.log is None:
+         self.log = self.find_log(status)
+         if self.log is None:
+            # not started yet, e.g. waiting behind other points of a bundle
+            return None
+         if status.start_time is not None and not self.bundled:
+            self.start_time = status.start_time
+      if self.timers is None:
+         timers = glob.glob(os.path.join(self.script.job_working_path,'pepper_diagnostics','*','timers.csv'))
+         if len(timers) == 1:
+            self.timers = FileTail(timers[0])
+
+      new_output = False
+      if self.log is not None:
+         for line in self.log.read_lines():
+            new_output = True
+            match = self.progress_re.search(line)
+            if match:
+               self.update_rate(int(match.group('events')),now)
+      if self.timers is not None:
+         lines = self.timers.read_lines()
+         self.timer_tasks += len(lines)
+         new_output = new_output or len(lines) > 0
+      if new_output or self.last_output is None:
+         self.last_output = now
+         if self.start_time is None:
+            self.start_time = now
+
+      self.flag = self.check(status,now)
+      return self.flag
+
+   def find_log(self, status):
+      # logs of earlier attempts at this point predate the job's start
+      logs = sorted(glob.glob(os.path.join(self.script.job_working_path,self.script.opts['job_name'] + '.o*')),key=os.path.getmtime)
+      if status.start_time is not None:
+         logs = [log for log in logs if os.path.getmtime(log) >= status.start_time]
+      return FileTail(logs[-1]) if logs else None
+
+   def update_rate(self, events, now):
+      if self.events is not None and now > self.event_time and events > self.events:
+         self.rate = (events - self.events) / (now - self.event_time)
+      self.events = events
+      self.event_time = now
+
+   def check(self, status, now):
+      # returns a reason to flag the run, or None
+      if status.state != RUNNING or self.last_output is None:
+         return None
+      if now - self.last_output > self.stall_seconds:
+         return 'stalled, no output for %d s' % (now - self.last_output)
+      if self.rate and self.walltime and self.start_time is not None:
+         remaining = max(self.total_events - self.events,0) / self.rate
+         projected = now - self.start_time + remaining
+         if projected > self.walltime:
+            return 'too slow, projected %d s for a walltime of %d s' % (projected,self.walltime)
+      return None
+
+   def describe(self):
+      rate = '%.3g events/s' % self.rate if self.rate else 'no rate yet'
+      done = '%d/%d events' % (self.events,self.total_events) if self.events is not None else 'no progress yet'
+      return f'{self.script.threads} threads {self.script.ranks} ranks: {done}, {rate}, {self.timer_tasks} timer rows'
+
+
+class CampaignMonitor:
+   ''' Follows every in-flight job of the submit loop. '''
+
+   def __init__(self, config, scheduler):
+      options = config.get('monitor',{})
+      self.scheduler = scheduler
+      self.progress_re = re.compile(options.get('progress_regex',DEFAULT_PROGRESS_REGEX))
+      self.stall_seconds = options.get('stall_seconds',DEFAULT_STALL_SECONDS)
+      self.delete_flagged = options.get('delete_flagged',False)
+      # points of a sequential bundle run one after another, only the latest started one is checked
+      self.sequential = config.get('bundle_mode','sequential') == 'sequential'
+      self.runs = {}
+      self.deleted = set()
+
+   def add(self, job_id, scripts):
+      bundled = len(scripts) > 1
+      self.runs[job_id] = [RunMonitor(job_id,script,self.progress_re,self.stall_seconds,bundled) for script in scripts]
+
+   def remove(self, job_id):
+      self.runs.pop(job_id,None)
+
+   def update(self, statuses, now=None):
+      # statuses: {job_id: JobStatus} from Scheduler.status_many, returns the job ids that were deleted
+      now = time.time() if now is None else now
+      deleted = []
+      for job_id,runs in self.runs.items():
+         status = statuses.get(job_id)
+         # queue time does not count towards stalling
+         if status is None or status.state != RUNNING or job_id in self.deleted:
+            continue
+         flags = [run.update(status,now) for run in runs]
+         started = [run for run in runs if run.started]
+         if self.sequential and started:
+            # earlier points have finished, later ones have not started yet
+            flags = [flag if run is started[-1] else None for run,flag in zip(runs,flags)]
+         for run,flag in zip(runs,flags):
+            if run.started:
+               logger.info('job %s %s',job_id,run.describe())
+            if flag is None:
+               continue
+            logger.warning('job %s %s threads %s ranks is %s\njob path: %s',job_id,run.script.threads,run.script.ranks,flag,run.script.job_working_path)
+            if self.delete_flagged and job_id not in self.deleted:
+               logger.warning('deleting job %s',job_id)
+               self.scheduler.delete(job_id)
+               self.deleted.add(job_id)
+               deleted.append(job_id)
+      return deleted
@@ -1,13 +1,23 @@
 import argparse
 import pandas as pd
-import matplotlib.pyplot as plt
-import matplotlib.gridspec as gridspec
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib.figure import Figure
 import glob
 import os
 import json
 import configparser
-import h5py as hp
-import subprocess
+from hdf5_reader import EventFile
+from analysis import aggregate_replicas, flag_high_variance, scaling_analysis
+from result_store import PARTITION_COLUMN, append_results, list_partitions, load_results, partition_key
+import re
+import concurrent.futures
+import functools
+import collections
+import hashlib
+import types
+import numpy as np
+import rank_profiler
 
 def main():
    parser = argparse.ArgumentParser(description='Plotting script for scaling tests.')
@@ -16,7 +26,12 @@ def main():
    parser.add_argument('-n', '--name', required=True, help='Name of the figure of merit for plot labels')
    parser.add_argument('-o', '--output-basename', required=True, help='output plot filename base, possibly including path.',default='')
 
-   parser.add_argument('--overwrite', action='store_true', help='reread input files and write out CSV files',default=False)
+   parser.add_argument('--overwrite', action='store_true', help='extract input files (unchanged runs are served from the manifest) and update the result store',default=False)
+   parser.add_argument('--workers', type=int, default=None, help='number of processes used to extract runs and render figures, defaults to the number of cores')
+   parser.add_argument('--timer-columns', default=None, help='json file mapping extra Pepper timer tasks to result column names')
+   parser.add_argument('--event-stats', action='store_true', help='stream event counts and weight sums from event_data.hdf5 during extraction',default=False)
+   parser.add_argument('--max-cv', type=float, default=0.05, help='flag replicated points whose event rate spread (std/mean) exceeds this, or whose change to a neighbouring scale is within the confidence intervals')
+   parser.add_argument('--no-cache', action='store_true', help='ignore and do not update the per-run extraction manifest',default=False)
    args = parser.parse_args()
 
    # Dynamically import the user-provided function
@@ -28,34 +43,50 @@ def main():
    if not fn_base.endswith('/') and not fn_base.endswith('.') and not fn_base.endswith('_'):
       fn_base = fn_base + '.'
 
+   timer_columns = load_timer_columns(args.timer_columns)
+   sweep_key = partition_key(args.input_path)
+   figures = []
+
    threads_base = os.path.join(args.input_path,'threads')
    if os.path.exists(threads_base):
-      if args.overwrite:
-         threads_df = extraction_function(threads_base)
-      else:
-         threads_df = pd.read_csv(fn_base + 'threads.csv.gz',index_col=0)
+      threads_df = get_results(threads_base,fn_base + 'threads',sweep_key,args,timer_columns,"Batch Size")
       title = "Thread Scaling for " + threads_df["Process"].loc[0]
-      plot_scaling_loglog(threads_df,"Batch Size","Number of Threads",args.name,args.name,title,fn_base+"thread_scaling.png",norm=False)
-      plot_scaling_loglog(threads_df,"Batch Size","Number of Threads",args.name,args.name + " (norm)",title,fn_base+"thread_scaling_norm.png",norm=True)
-      if args.overwrite:
-         threads_df.to_csv(fn_base + 'threads.csv.gz',compression='gzip')
+      figures += [
+         FigureSpec(plot_scaling_loglog,fn_base+"thread_scaling.png",
+                    dict(df=threads_df,x_key="Batch Size",x_label="Number of Threads",y_key=args.name,y_label=args.name,title=title,norm=False)),
+         FigureSpec(plot_scaling_loglog,fn_base+"thread_scaling_norm.png",
+                    dict(df=threads_df,x_key="Batch Size",x_label="Number of Threads",y_key=args.name,y_label=args.name + " (norm)",title=title,norm=True)),
+         FigureSpec(plot_efficiency,fn_base+"thread_efficiency.png",
+                    dict(df=threads_df,x_key="Batch Size",x_label="Number of Threads",title=title)),
+      ]
 
    ranks_base = os.path.join(args.input_path,'ranks')
    if os.path.exists(ranks_base):
-      if args.overwrite:
-         ranks_df = extraction_function(ranks_base)
-      else:
-         ranks_df = pd.read_csv(fn_base + 'ranks.csv.gz',index_col=0)
+      ranks_df = get_results(ranks_base,fn_base + 'ranks',sweep_key,args,timer_columns,"N Ranks")
       title = "Rank Scaling for " + ranks_df["Process"].loc[0]
       ranks_df = ranks_df.sort_values(by="N Ranks")
-      plot_scaling_loglog(ranks_df,"N Ranks","Number of Ranks",args.name,args.name,title,fn_base+"rank_scaling.png",norm=False)
-      plot_scaling_loglog(ranks_df,"N Ranks","Number of Ranks",args.name,args.name + " (norm)",title,fn_base+"rank_scaling_norm.png",norm=True)
-      plot_runtime_breakdown(ranks_df,fn_base)
-      create_two_plot_figure(ranks_df,"N Ranks",fn_base+"runtime_to_bash_ratio.png")
-      plot_and_ratio(ranks_df,"N Ranks","Total Runtime",fn_base+"runtime.png")
-      plot_and_ratio(ranks_df,"N Ranks","Event Rate",fn_base+"event_rate.png")
-      if args.overwrite:
-         ranks_df.to_csv(fn_base + 'ranks.csv.gz',compression='gzip')
+      figures += [
+         FigureSpec(plot_scaling_loglog,fn_base+"rank_scaling.png",
+                    dict(df=ranks_df,x_key="N Ranks",x_label="Number of Ranks",y_key=args.name,y_label=args.name,title=title,norm=False)),
+         FigureSpec(plot_scaling_loglog,fn_base+"rank_scaling_norm.png",
+                    dict(df=ranks_df,x_key="N Ranks",x_label="Number of Ranks",y_key=args.name,y_label=args.name + " (norm)",title=title,norm=True)),
+         FigureSpec(plot_efficiency,fn_base+"rank_efficiency.png",
+                    dict(df=ranks_df,x_key="N Ranks",x_label="Number of Ranks",title=title)),
+         FigureSpec(create_two_plot_figure,fn_base+"runtime_to_bash_ratio.png",dict(df=ranks_df,x_label="N Ranks")),
+         FigureSpec(plot_and_ratio,fn_base+"runtime.png",dict(df=ranks_df,x_col="N Ranks",y_col="Total Runtime")),
+         FigureSpec(plot_and_ratio,fn_base+"event_rate.png",dict(df=ranks_df,x_col="N Ranks",y_col="Event Rate")),
+      ]
+      figures += runtime_breakdown_specs(ranks_df,fn_base)
+      if 'Rank Profile Filename' in ranks_df and ranks_df['Rank Profile Filename'].notna().any():
+         figures.append(FigureSpec(plot_rank_heatmap,fn_base+"rank_heatmap.png",dict(df=ranks_df,x_key="N Ranks")))
+
+   sweep_base = os.path.join(args.input_path,'sweep')
+   if os.path.exists(sweep_base):
+      sweep_df = get_results(sweep_base,fn_base + 'sweep',sweep_key,args,timer_columns)
+      dimensions = [column for column in sweep_df.columns if column.startswith(SWEEP_PREFIX)]
+      figures += sweep_figure_specs(sweep_df,dimensions,args.name,fn_base + 'sweep_')
+
+   render_figures(figures,fn_base + 'figure_hashes.json',args.workers)
 
    # Assuming the extraction function returns a dataframe
    # df_list = [extraction_function(file) for file in sorted(glob.glob(data_glob))]
@@ -69,7 +100,100 @@ def main():
    # plot_thread_scaling(df, figure_of_merit_name)
    # plot_rank_scaling(df, figure_of_merit_name)
 
-def plot_runtime_breakdown(df,output_basename):
+def get_results(base_path,store_base,sweep_key,args,timer_columns,x_key=None):
+   # extract the sweep and store it with --overwrite, otherwise read it back from the result store,
+   # sweeps over a single x_key get the scaling analysis columns
+   store_path = store_base + '.parquet'
+   if args.overwrite:
+      df = extraction_function(base_path,args.workers,not args.no_cache,timer_columns,args.event_stats)
+      if x_key is not None:
+         df = scaling_analysis(df,x_key)
+      df = flag_high_variance(df,x_key,max_cv=args.max_cv)
+      append_results(store_path,df,sweep_key)
+      return df
+   if sweep_key in list_partitions(store_path):
+      # a single partition, its key column would only make the figure hashes differ from an --overwrite run
+      df = load_results(store_path,keys=[sweep_key]).drop(columns=[PARTITION_COLUMN])
+   else:
+      # results written before the Parquet store existed
+      df = pd.read_csv(store_base + '.csv.gz',index_col=0)
+   if x_key is not None:
+      df = scaling_analysis(df,x_key)
+   return flag_high_variance(df,x_key,max_cv=args.max_cv)
+
+# plotting helpers under this directory count towards the figure hashes
+CODE_PATH = os.path.dirname(os.path.abspath(__file__)) + os.sep
+# figure to render: function(output_filename=output_filename, **kwargs)
+FigureSpec = collections.namedtuple('FigureSpec',['function','output_filename','kwargs'])
+
+
+def render_figures(specs, hash_filename, workers=None):
+   # render figure specs on a process pool, skipping figures whose output
+   # exists and whose input data and plotting code hash is unchanged
+   hashes = {}
+   if os.path.exists(hash_filename):
+      with open(hash_filename) as f:
+         hashes = json.load(f)
+   todo = []
+   for spec in specs:
+      digest = figure_hash(spec)
+      if hashes.get(spec.output_filename) == digest and os.path.exists(spec.output_filename):
+         continue
+      hashes[spec.output_filename] = digest
+      todo.append(spec)
+
+   if workers is None:
+      workers = os.cpu_count()
+   if workers > 1 and len(todo) > 1:
+      with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers,len(todo))) as pool:
+         list(pool.map(render_figure,todo))
+   else:
+      for spec in todo:
+         render_figure(spec)
+   print('rendered %d figures, %d unchanged' % (len(todo),len(specs) - len(todo)))
+
+   with open(hash_filename,'w') as f:
+      json.dump(hashes,f,indent=1)
+
+
+def render_figure(spec):
+   spec.function(output_filename=spec.output_filename,**spec.kwargs)
+
+
+def figure_hash(spec):
+   digest = hashlib.sha1()
+   digest.update(spec.function.__name__.encode())
+   update_code_hash(digest,spec.function.__code__,spec.function.__globals__,set())
+   for key,value in sorted(spec.kwargs.items()):
+      digest.update(key.encode())
+      if isinstance(value,pd.DataFrame):
+         digest.update(repr(list(value.columns)).encode())
+         digest.update(pd.util.hash_pandas_object(value,index=True).values.tobytes())
+      else:
+         digest.update(repr(value).encode())
+   return digest.hexdigest()
+
+
+def update_code_hash(digest, code, namespace, seen):
+   # nested code objects (comprehensions) would otherwise hash by address
+   digest.update(code.co_code)
+   for const in code.co_consts:
+      if isinstance(const,types.CodeType):
+         update_code_hash(digest,const,namespace,seen)
+      else:
+         digest.update(repr(const).encode())
+   # helpers from this repository the code calls, directly or as module.helper,
+   # are hashed along with it so changing e.g. error_bars re-renders its figures
+   modules = [value for value in map(namespace.get,code.co_names)
+              if isinstance(value,types.ModuleType) and getattr(value,'__file__','').startswith(CODE_PATH)]
+   for name in code.co_names:
+      for helper in [namespace.get(name)] + [getattr(module,name,None) for module in modules]:
+         if isinstance(helper,types.FunctionType) and helper not in seen and helper.__code__.co_filename.startswith(CODE_PATH):
+            seen.add(helper)
+            update_code_hash(digest,helper.__code__,helper.__globals__,seen)
+
+
+def runtime_breakdown_specs(df,output_basename):
 
    # Define the groups of columns
    top_level_columns = ['Event Generation Runtime', 'Optimisation Runtime',
@@ -85,35 +209,38 @@ def plot_runtime_breakdown(df,output_basename):
                         "EG-R ME2 update",
                         "EG-R ME reset","EG-R IC reset"]
 
+   return [
+      FigureSpec(plot_fraction_breakdown,output_basename + 'total_runtime.png',
+                 dict(df=df,columns=top_level_columns,total_column='Total Runtime',xlabel='N Ranks')),
+      FigureSpec(plot_fraction_breakdown,output_basename + 'eg_runtime.png',
+                 dict(df=df,columns=event_generation_columns,total_column='Event Generation Runtime',xlabel='N Ranks')),
+      FigureSpec(plot_fraction_breakdown,output_basename + 'recursion_runtime.png',
+                 dict(df=df,columns=recursion_columns,total_column='EG Recursion',xlabel='N Ranks')),
+   ]
+
 
-   # Function to create the plot
-   def create_plot(df, columns, total_column, xlabel, output_filename):
-      # Calculate the fractions
-      fractions = df[columns].div(df[total_column], axis=0)
-      fractions[xlabel] = df[xlabel]
-      
-      plt.figure(dpi=240)
-      # Plot the data
-      fractions.plot(x=xlabel, kind='bar', stacked=True, ax=plt.gca())
-      plt.ylim(0, 1)
-      plt.ylabel('Fraction of Total Runtime')
-      plt.title('Fraction of Total Runtime per Component')
-      plt.grid(axis='y')
-      
-      plt.tight_layout()
-      plt.savefig(output_filename)
-      plt.close("all")
-      
-   # Create the plots
-   create_plot(df, top_level_columns, 'Total Runtime', 'N Ranks',output_basename + 'total_runtime.png')
-   create_plot(df, event_generation_columns, 'Event Generation Runtime', 'N Ranks',output_basename + 'eg_runtime.png')
-   create_plot(df, recursion_columns, 'EG Recursion', 'N Ranks',output_basename + 'recursion_runtime.png')
+def plot_fraction_breakdown(df, columns, total_column, xlabel, output_filename):
+   # Calculate the fractions
+   fractions = df[columns].div(df[total_column], axis=0)
+   fractions[xlabel] = df[xlabel]
+   
+   fig = Figure(dpi=240)
+   ax = fig.add_subplot()
+   # Plot the data
+   fractions.plot(x=xlabel, kind='bar', stacked=True, ax=ax)
+   ax.set_ylim(0, 1)
+   ax.set_ylabel('Fraction of Total Runtime')
+   ax.set_title('Fraction of Total Runtime per Component')
+   ax.grid(axis='y')
+   
+   fig.tight_layout()
+   fig.savefig(output_filename)
 
 # Function to create a figure with two plots
 def create_two_plot_figure(df, x_label,output_filename):
    # Create a figure with specified grid spec
-   fig = plt.figure(figsize=(8, 6))
-   spec = gridspec.GridSpec(nrows=2, ncols=1, height_ratios=[3, 1], hspace=0.0)
+   fig = Figure(figsize=(8, 6))
+   spec = fig.add_gridspec(nrows=2, ncols=1, height_ratios=[3, 1], hspace=0.0)
    
    # Top plot (75% of the space)
    ax1 = fig.add_subplot(spec[0])
@@ -141,7 +268,6 @@ def create_two_plot_figure(df, x_label,output_filename):
    fig.tight_layout()
    
    fig.savefig(output_filename)
-   plt.close("all")
 
 
 def plot_and_ratio(df,x_col,y_col,output_filename):
@@ -150,9 +276,12 @@ def plot_and_ratio(df,x_col,y_col,output_filename):
    y_data = df[y_col].values
 
    # Create main plot
-   fig, ax = plt.subplots(2, 1, gridspec_kw={'height_ratios': [3, 1], 'hspace': 0}, sharex=True)
+   fig = Figure()
+   ax = fig.subplots(2, 1, gridspec_kw={'height_ratios': [3, 1], 'hspace': 0}, sharex=True)
    
-   ax[0].plot(x_data, y_data, marker='o', linestyle='-')
+   y_err = error_bars(df, y_col)
+   ax[0].errorbar(x_data, y_data, yerr=y_err, marker='o', linestyle='-', capsize=3)
+   mark_high_variance(ax[0], df, x_data, y_data)
    ax[0].set_ylabel(y_col)
    # ax[0].set_title("Total Runtime vs. N Ranks")
    ax[0].grid(axis='y')
@@ -160,105 +289,410 @@ def plot_and_ratio(df,x_col,y_col,output_filename):
    # Create normalized plot at the bottom
    min_y_data = y_data[x_data == x_data.min()][0]  # Get y_data for smallest rank
    normalized_y_data = y_data / min_y_data
-   ax[1].plot(x_data, normalized_y_data, marker='o', linestyle='-', color='r')
+   ax[1].errorbar(x_data, normalized_y_data, yerr=y_err / min_y_data if y_err is not None else None, marker='o', linestyle='-', color='r', capsize=3)
    ax[1].set_xlabel(x_col)
    ax[1].set_ylabel("Normalized " + y_col)
    ax[1].grid(axis='y')
 
    fig.tight_layout()
    fig.savefig(output_filename)
-   plt.close("all")
+
+def error_bars(df, y_key):
+   # [below, above] distances to the confidence interval of replicated results, None for single runs
+   low, high = y_key + ' CI Low', y_key + ' CI High'
+   if low not in df or df[low].isna().all():
+      return None
+   return np.nan_to_num(np.array([df[y_key] - df[low], df[high] - df[y_key]])).clip(0)
+
+
+def mark_high_variance(ax, df, x, y):
+   # circle points whose spread is too large to trust the scaling between them, returns True if any
+   if 'High Variance' not in df or not df['High Variance'].any():
+      return False
+   flagged = df['High Variance'].to_numpy(dtype=bool)
+   ax.plot(np.asarray(x)[flagged], np.asarray(y)[flagged], 'o', markersize=12, markerfacecolor='none', markeredgecolor='r', label='high variance')
+   return True
+
+
+def sweep_figure_specs(df, dimensions, y_key, output_basename):
+   # one figure per numeric swept dimension on the x axis
+   return [FigureSpec(plot_sweep,output_basename + x_key[len(SWEEP_PREFIX):] + '.png',
+                      dict(df=df,dimensions=dimensions,x_key=x_key,y_key=y_key))
+           for x_key in dimensions if pd.api.types.is_numeric_dtype(df[x_key])]
+
+
+def plot_sweep(df, dimensions, x_key, y_key, output_filename):
+   # faceted on the first remaining dimension with one line per combination of the others
+   others = [key for key in dimensions if key != x_key]
+   facet_key = others[0] if others else None
+   line_keys = others[1:]
+   facets = sorted(df[facet_key].unique()) if facet_key else [None]
+
+   fig = Figure(figsize=(5 * len(facets), 4), dpi=240)
+   axes = fig.subplots(1, len(facets), sharey=True, squeeze=False)
+   for ax,facet in zip(axes[0],facets):
+      facet_df = df if facet_key is None else df[df[facet_key] == facet]
+      groups = facet_df.groupby(line_keys) if line_keys else [((),facet_df)]
+      for values,group in groups:
+         group = group.sort_values(by=x_key)
+         values = values if isinstance(values,tuple) else (values,)
+         label = ', '.join(f'{key[len(SWEEP_PREFIX):]}={value}' for key,value in zip(line_keys,values))
+         ax.loglog(group[x_key], group[y_key], 'o-', label=label or None)
+      ax.set_xlabel(x_key[len(SWEEP_PREFIX):])
+      if facet_key is not None:
+         ax.set_title(f'{facet_key[len(SWEEP_PREFIX):]}={facet}')
+      ax.grid(which='major', linestyle='-', alpha=0.7)
+      ax.grid(which='minor', linestyle=':', alpha=0.5)
+      if line_keys:
+         ax.legend(fontsize='small')
+   axes[0][0].set_ylabel(y_key)
+   fig.tight_layout()
+   fig.savefig(output_filename)
+
 
 def plot_scaling_loglog(df, x_key, x_label, y_key, y_label, title, output_filename, norm=False):
    df = df.sort_values(by=x_key)
-   plt.figure(dpi=240)
+   fig = Figure(dpi=240)
+   ax = fig.add_subplot()
    x = df[x_key]
    y = df[y_key]
-   if norm:
-      y = y / df[y_key].loc[0]
-   plt.loglog(x, y, 'o-')
+   # normalise to the smallest scale
+   scale = y.iloc[0] if norm else 1.
+   y_err = error_bars(df, y_key)
+   ax.errorbar(x, y / scale, yerr=y_err / scale if y_err is not None else None, fmt='o-', capsize=3, label='measured')
+   ax.set_xscale('log')
+   ax.set_yscale('log')
+   if mark_high_variance(ax, df, x, y / scale):
+      ax.legend(fontsize='small')
+   if y_key == 'Event Rate' and 'Amdahl Speedup Fit' in df:
+      ax.loglog(x, df['Amdahl Speedup Fit'] * y.iloc[0] / scale, '--', label='Amdahl fit (s=%.3g)' % df['Amdahl Serial Fraction'].iloc[0])
+      ax.loglog(x, df['Gustafson Speedup Fit'] * y.iloc[0] / scale, ':', label='Gustafson fit (s=%.3g)' % df['Gustafson Serial Fraction'].iloc[0])
+      if df['Comm Model Rate Fit'].notna().all():
+         ax.loglog(x, df['Comm Model Rate Fit'] / scale, '-.', label='communication model fit')
+      ax.legend(fontsize='small')
+
+   ax.set_xlabel(x_label)
+   ax.set_ylabel(y_label)
+   ax.grid(which='major', linestyle='-', alpha=0.7)
+   ax.grid(which='minor', linestyle=':', alpha=0.5)
+   ax.set_title(title)
+   fig.tight_layout()
+   fig.savefig(output_filename)
+
+
+
+def plot_efficiency(df, x_key, x_label, title, output_filename):
+   # speedup against ideal and the fitted models on top, parallel efficiency
+   # with the efficiency knee and the communication model optimum below
+   df = df.sort_values(by=x_key)
+   x = df[x_key]
+   fig = Figure(dpi=240)
+   ax = fig.subplots(2, 1, sharex=True, gridspec_kw={'height_ratios': [2, 1], 'hspace': 0})
+   ax[0].loglog(x, df['Speedup'], 'o-', label='measured')
+   ax[0].loglog(x, x / x.iloc[0], 'k-', alpha=0.3, label='ideal')
+   ax[0].loglog(x, df['Amdahl Speedup Fit'], '--', label='Amdahl fit (s=%.3g)' % df['Amdahl Serial Fraction'].iloc[0])
+   ax[0].loglog(x, df['Gustafson Speedup Fit'], ':', label='Gustafson fit (s=%.3g)' % df['Gustafson Serial Fraction'].iloc[0])
+   ax[0].set_ylabel('Speedup')
+   ax[0].set_title(title)
+   ax[0].grid(which='major', linestyle='-', alpha=0.7)
+
+   ax[1].semilogx(x, df['Parallel Efficiency'], 'o-', color='r')
+   ax[1].set_ylim(0, max(1.1, df['Parallel Efficiency'].max() * 1.1))
+   knee = df['Efficiency Knee'].iloc[0]
+   if pd.notna(knee):
+      for a in ax:
+         a.axvline(knee, color='gray', linestyle='--')
+      ax[0].plot([], [], color='gray', linestyle='--', label='efficiency knee (%g)' % knee)
+   optimum = df['Comm Model Optimal Scale'].iloc[0]
+   if pd.notna(optimum):
+      for a in ax:
+         a.axvline(optimum, color='green', linestyle='-.')
+      ax[0].plot([], [], color='green', linestyle='-.', label='model optimum (%.3g)' % optimum)
+   ax[0].legend(fontsize='small')
+   ax[1].set_ylabel('Efficiency')
+   ax[1].set_xlabel(x_label)
+   ax[1].grid(which='major', linestyle='-', alpha=0.7)
+
+   fig.tight_layout()
+   fig.savefig(output_filename)
 
-   plt.xlabel(x_label)
-   plt.ylabel(y_label)
-   plt.grid(which='major', linestyle='-', alpha=0.7)
-   plt.grid(which='minor', linestyle=':', alpha=0.5)
-   # plt.legend()
-   plt.title(title)
-   plt.tight_layout()
-   plt.savefig(output_filename)
-   plt.close("all")
 
+def plot_rank_heatmap(df, x_key, output_filename):
+   # wall time of every rank relative to the mean of its run, one row per profiled run,
+   # the straggler of each run marked with a cross
+   df = df.dropna(subset=['Rank Profile Filename']).sort_values(by=x_key)
+   walls = []
+   for filename in df['Rank Profile Filename']:
+      records,_ = rank_profiler.load_profile(os.path.dirname(filename))
+      walls.append({record['rank']: record['wall'] for record in records})
+   n_ranks = max(max(run_walls,default=-1) + 1 for run_walls in walls)
+   ratio = np.full((len(walls),n_ranks),np.nan)
+   for row,run_walls in enumerate(walls):
+      if run_walls:
+         mean = np.mean(list(run_walls.values()))
+         ratio[row,list(run_walls)] = np.array(list(run_walls.values())) / mean
+   spread = max(np.nanmax(np.abs(ratio - 1.)),0.05) if np.isfinite(ratio).any() else 0.05
+
+   fig = Figure(figsize=(10,1.5 + 0.4 * len(walls)),dpi=240)
+   ax = fig.add_subplot()
+   image = ax.imshow(ratio,aspect='auto',interpolation='nearest',cmap='coolwarm',vmin=1. - spread,vmax=1. + spread)
+   for row,run_walls in enumerate(walls):
+      if run_walls:
+         ax.plot(max(run_walls,key=run_walls.get),row,'kx')
+   ax.set_yticks(range(len(walls)))
+   ax.set_yticklabels(df[x_key].astype(str))
+   ax.set_ylabel(x_key)
+   ax.set_xlabel('Rank')
+   ax.set_title('Per-rank Runtime')
+   fig.colorbar(image,ax=ax,label='Rank Runtime / Mean')
+   fig.tight_layout()
+   fig.savefig(output_filename)
 
 
-def extraction_function(base_path):
+# inputs read for each run, relative to the run directory; their path, mtime
+# and size make up the signature stored in the extraction manifest
+RUN_INPUT_PATTERNS = [
+   'pepper_diagnostics/*/timers.csv',
+   'pepper_config.ini',
+   'event_data.hdf5',
+   'pepper_scaling.o*',
+   'parallel_config.json',
+   'sweep_point.json',
+   'rank_profile.json.gz',
+   'rank_profile/rank_*.json',
+]
+REPLICA_DIR_RE = re.compile(r'^replica_(\d+)$')
+MANIFEST_FILENAME = '.extraction_manifest.json'
+MANIFEST_VERSION = 6
+
+
+def extraction_function(base_path, workers=None, use_cache=True, timer_columns=None, event_stats=False):
    # filename: "/path/to/output/{threads,ranks}/"
-   subdirs = sorted(glob.glob(base_path + '/*',recursive=False))
-   # print(subdirs)
-   rows = []
+   if timer_columns is None:
+      timer_columns = TIMER_COLUMNS
+   # anything that changes the extracted rows invalidates the manifest
+   options = {'timer_columns': timer_columns, 'event_stats': event_stats}
+   subdirs = [d for d in sorted(glob.glob(base_path + '/*',recursive=False)) if os.path.isdir(d)]
+   # points run with repeats have one run per replica_<n> subdirectory
+   run_dirs = []
    for subdir in subdirs:
-      csv_dict = extract_timers_csv(subdir)
-      ini_dict = extract_ini(subdir)
-      csv_dict.update(ini_dict)
-      xs_dict = extract_final_xs_hdf5(subdir)
-      csv_dict.update(xs_dict)
-      run_time = extract_log_data(subdir)
-      csv_dict.update(run_time)
-      parallel_dict = extract_parallel_config(subdir)
-      csv_dict.update(parallel_dict)
-      if csv_dict['Process'] == '' and csv_dict['Batch Size'] == 0:
+      replicas = [d for d in sorted(glob.glob(os.path.join(subdir,'replica_*'))) if os.path.isdir(d) and REPLICA_DIR_RE.match(os.path.basename(d))]
+      run_dirs.extend(replicas if replicas else [subdir])
+   manifest_fn = os.path.join(base_path,MANIFEST_FILENAME)
+   manifest = load_manifest(manifest_fn,options) if use_cache else {}
+
+   # stat calls are slow on parallel filesystems, so overlap them with threads
+   with concurrent.futures.ThreadPoolExecutor(max_workers=16) as pool:
+      signatures = list(pool.map(run_signature,run_dirs))
+
+   runs = {}
+   todo = []
+   for subdir,signature in zip(run_dirs,signatures):
+      name = os.path.relpath(subdir,base_path)
+      entry = manifest.get(name)
+      if entry is not None and entry['signature'] == signature:
+         runs[name] = entry
+      else:
+         todo.append((subdir,signature))
+
+   if workers is None:
+      workers = os.cpu_count()
+   run_extractor = functools.partial(extract_run,timer_columns=timer_columns,event_stats=event_stats)
+   if workers > 1 and len(todo) > 1:
+      with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers,len(todo))) as pool:
+         extracted = list(pool.map(run_extractor,[subdir for subdir,_ in todo]))
+   else:
+      extracted = [run_extractor(subdir) for subdir,_ in todo]
+   for (subdir,signature),row in zip(todo,extracted):
+      runs[os.path.relpath(subdir,base_path)] = {'signature': signature, 'row': row}
+
+   print('extracted %d runs, %d from cache: %s' % (len(todo),len(runs) - len(todo),base_path))
+   if use_cache:
+      write_manifest(manifest_fn,options,runs)
+
+   replicated = any(os.sep in name for name in runs)
+   rows = []
+   for name in sorted(runs):
+      row = runs[name]['row']
+      if row is None:
          continue
-      # print(csv_dict)
-      rows.append(csv_dict)
+      if replicated:
+         point,_,replica = name.partition(os.sep)
+         row = dict(row,Point=point,Replica=int(REPLICA_DIR_RE.match(replica).group(1)) if replica else 0)
+      rows.append(row)
    df = pd.DataFrame(rows)
    df['Batch Size'] = df['Batch Size'].astype(int)
    df['N Batches'] = df['N Batches'].astype(int)
    df['Event Period'] = df['Event Generation Runtime'] / df['Batch Size'] / df['N Batches']
    df['Event Rate'] = 1. / df['Event Period']
 
+   if replicated:
+      stat_columns = [column for column in df.columns if column in timer_columns.values() or column.startswith('Timer ')]
+      df = aggregate_replicas(df,stat_columns + ['Bash Runtime','Event Period','Event Rate'])
    return df
 
 
+def extract_run(base_path, timer_columns=None, event_stats=False):
+   # base_path: "/path/to/output/{threads,ranks}/<num>-threads_<num>-ranks/"
+   # returns None for directories that do not contain a run
+   csv_dict = extract_timers_csv(base_path,timer_columns)
+   ini_dict = extract_ini(base_path)
+   csv_dict.update(ini_dict)
+   xs_dict = extract_final_xs_hdf5(base_path,event_stats)
+   csv_dict.update(xs_dict)
+   run_time = extract_log_data(base_path)
+   csv_dict.update(run_time)
+   parallel_dict = extract_parallel_config(base_path)
+   csv_dict.update(parallel_dict)
+   csv_dict.update(extract_sweep_point(base_path))
+   csv_dict.update(extract_rank_profile(base_path))
+   if csv_dict['Process'] == '' and csv_dict['Batch Size'] == 0:
+      return None
+   # make values plain python types so they can be stored in the manifest
+   return {key: value.item() if hasattr(value,'item') else value for key,value in csv_dict.items()}
+
+
+def run_signature(base_path):
+   # list of [relative path, mtime in ns, size] for every input file of a run
+   signature = []
+   for pattern in RUN_INPUT_PATTERNS:
+      for filename in sorted(glob.glob(os.path.join(base_path,pattern))):
+         try:
+            stat = os.stat(filename)
+         except OSError:
+            continue
+         signature.append([os.path.relpath(filename,base_path),stat.st_mtime_ns,stat.st_size])
+   return signature
+
+
+def load_manifest(manifest_fn,options):
+   if not os.path.exists(manifest_fn):
+      return {}
+   try:
+      with open(manifest_fn) as f:
+         manifest = json.load(f)
+   except (OSError,ValueError):
+      print('ignoring unreadable manifest: ',manifest_fn)
+      return {}
+   if manifest.get('version') != MANIFEST_VERSION or manifest.get('options') != options:
+      return {}
+   return manifest['runs']
+
+
+def write_manifest(manifest_fn,options,runs):
+   manifest = {'version': MANIFEST_VERSION, 'options': options, 'runs': runs}
+   tmp_fn = manifest_fn + '.tmp'
+   try:
+      with open(tmp_fn,'w') as f:
+         json.dump(manifest,f)
+      os.replace(tmp_fn,manifest_fn)
+   except OSError as e:
+      print('failed to write manifest: ',manifest_fn,e)
+
+
+# "[$SECONDS] <text>" markers echoed by the run templates, e.g. "[12] pepper start";
+# the tag is the text up to its first digit or "=", so "[3] passed threads=64 ranks=4"
+# is tagged "passed threads" and "[3] PWD=/path" is tagged "PWD"
+LOG_MARKER_RE = re.compile(rb'^\[(\d+)\] (.+?)[ \t]*\r?$',re.MULTILINE)
+LOG_TAG_RE = re.compile(r'^[^\d=]*')
+LOG_START_TAG = 'pepper start'
+LOG_DONE_TAG = 'pepper done'
+LOG_CHUNK_SIZE = 4 * 1024 * 1024
+
+
 def extract_log_data(base_path):
    # base_path: "/path/to/output/{threads,ranks}/<num>-threads_<num>-ranks/"
    filenames = sorted(glob.glob(os.path.join(base_path,'pepper_scaling.o*')))
    duration = 0
    filename = 'None'
+   markers = {}
    if len(filenames) > 0:
       filename = filenames[-1]
-      cmd = 'grep "pepper start" %s' % filename
-      result = subprocess.run(cmd, capture_output=True, shell=True, text=True)
-      start_str = str(result.stdout)
-      start_time = int(start_str.split(']')[0].replace('[',''))
-
-      cmd = 'grep "pepper done" %s' % filename
-      result = subprocess.run(cmd, capture_output=True, shell=True, text=True)
-      stop_str = str(result.stdout)
-      if len(stop_str) > 1:
-         stop_time = int(stop_str.split(']')[0].replace('[',''))
-         duration = stop_time - start_time
-   return {
+      markers = scan_log_markers(filename)
+      if LOG_START_TAG in markers and LOG_DONE_TAG in markers:
+         duration = markers[LOG_DONE_TAG] - markers[LOG_START_TAG]
+   log_dict = {
       "Bash Runtime": duration,
       "Log Filename": filename,
    }
-
-
-def extract_final_xs_hdf5(base_path):
+   for tag,seconds in markers.items():
+      log_dict['Log ' + tag + ' [s]'] = seconds
+   return log_dict
+
+
+def scan_log_markers(filename):
+   # returns {tag: seconds} for the first occurrence of every marker in the log
+   with open(filename,'rb') as f:
+      size = os.fstat(f.fileno()).st_size
+      if size > 2 * LOG_CHUNK_SIZE:
+         # markers echoed after the launch sit at the very end of a verbose log,
+         # so look there first and only stream the head up to the start marker;
+         # markers between the start marker and the last LOG_CHUNK_SIZE bytes are
+         # not seen, the templates echo none there
+         f.seek(size - LOG_CHUNK_SIZE)
+         tail = f.read()
+         tail_markers = parse_log_markers(tail[tail.find(b'\n') + 1:])
+         if LOG_DONE_TAG in tail_markers:
+            f.seek(0)
+            markers = stream_log_markers(f,stop_tag=LOG_START_TAG)
+            for tag,seconds in tail_markers.items():
+               markers.setdefault(tag,seconds)
+            return markers
+         f.seek(0)
+      return stream_log_markers(f)
+
+
+def stream_log_markers(f,stop_tag=None):
+   # read the file in large chunks, carrying incomplete lines over to the next one
+   markers = {}
+   remainder = b''
+   while True:
+      chunk = f.read(LOG_CHUNK_SIZE)
+      if not chunk:
+         break
+      chunk = remainder + chunk
+      end = chunk.rfind(b'\n') + 1
+      remainder = chunk[end:]
+      for tag,seconds in parse_log_markers(chunk[:end]).items():
+         markers.setdefault(tag,seconds)
+      if stop_tag is not None and stop_tag in markers:
+         return markers
+   for tag,seconds in parse_log_markers(remainder).items():
+      markers.setdefault(tag,seconds)
+   return markers
+
+
+def parse_log_markers(data):
+   markers = {}
+   for match in LOG_MARKER_RE.finditer(data):
+      tag = LOG_TAG_RE.match(match.group(2).decode('utf-8','replace')).group().strip()
+      if tag:
+         markers.setdefault(tag,int(match.group(1)))
+   return markers
+
+
+def extract_final_xs_hdf5(base_path, event_stats=False):
    # base_path: "/path/to/output/{threads,ranks}/<num>-threads_<num>-ranks/"
+   # event_stats also streams event counts and weight sums over the event table
    filename = os.path.join(base_path,'event_data.hdf5')
    xs_mean = 0.
    xs_sigma = 0.
+   stats = {}
    if os.path.exists(filename):
       try:
-         data = hp.File(filename)
-         xs_mean = data['generatedResult'][0]
-         xs_sigma = data['generatedResult'][1]
-      except:
-         print('failed to open file: ',filename)
-   return {
+         with EventFile(filename) as events:
+            xs_mean, xs_sigma = events.read('generatedResult',slice(0,2))
+            if event_stats:
+               stats = events.stream_stats()
+      except (OSError,KeyError,ValueError) as e:
+         print('failed to read file: ',filename,e)
+   xs_dict = {
       'xs_mean': xs_mean,
       'xs_sigma': xs_sigma,
       "HDF5 Filename": filename,
    }
+   xs_dict.update(stats)
+   return xs_dict
 
 def extract_ini(base_path):
    # base_path: "/path/to/output/{threads,ranks}/<num>-threads_<num>-ranks/"
@@ -298,40 +732,106 @@ def extract_parallel_config(base_path):
       'Parallel Config Filename': config_json_fn
    }
 
-def extract_timers_csv(base_path):
+# Pepper timer task -> result column, tasks that are not listed are kept as "Timer <task>"
+TIMER_COLUMNS = {
+   'Total':                               'Total Runtime',
+   'Event generation':                    'Event Generation Runtime',
+   'Optimisation':                        'Optimisation Runtime',
+   'Initialisation':                      'Initialisation Runtime',
+   'HDF5 close':                          'HDF5 Close Runtime',
+   'Unweighting setup':                   'Unweighting Setup Runtime',
+   'Recursion':                           'EG Recursion',
+   'Output':                              'EG Output',
+   'PDF and AlphaS evaluation':           'EG PDF and AlphaS evaluation',
+   'Phase space':                         'EG Phase space',
+   'Calculate currents':                  'EG-R Calculate currents',
+   'Momenta preparation':                 'EG-R Momenta preparation',
+   'Currents preparation':                'EG-R Currents preparation',
+   'Internal particle information reset': 'EG-R IP reset',
+   'ME update':                           'EG-R ME update',
+   'ME2 update':                          'EG-R ME2 update',
+   'ME reset':                            'EG-R ME reset',
+   'Internal currents reset':             'EG-R IC reset',
+}
+
+
+def load_timer_columns(filename):
+   # json file of {"Pepper task": "result column"} entries added to TIMER_COLUMNS
+   timer_columns = dict(TIMER_COLUMNS)
+   if filename is not None:
+      with open(filename) as f:
+         timer_columns.update(json.load(f))
+   return timer_columns
+
+
+SWEEP_PREFIX = 'Sweep '
+
+
+def extract_sweep_point(base_path):
+   # base_path: "/path/to/output/sweep/<num>-threads_<num>-ranks[_<key>-<value>...]/"
+   # swept dimensions become "Sweep <key>" columns, weak scaled options "<key> (weak scaled)"
+   sweep_json_fn = os.path.join(base_path,'sweep_point.json')
+   if not os.path.exists(sweep_json_fn) and REPLICA_DIR_RE.match(os.path.basename(os.path.normpath(base_path))):
+      # replicas share the sweep point file of their point
+      sweep_json_fn = os.path.join(os.path.dirname(os.path.normpath(base_path)),'sweep_point.json')
+   if not os.path.exists(sweep_json_fn):
+      return {}
+   with open(sweep_json_fn) as f:
+      point = json.load(f)
+   sweep_dict = {SWEEP_PREFIX + key: value for key,value in point['dimensions'].items()}
+   sweep_dict.update({key + ' (weak scaled)': value for key,value in point['weak_scaled'].items()})
+   return sweep_dict
+
+
+def extract_timers_csv(base_path, timer_columns=None):
    # base_path: "/path/to/output/{threads,ranks}/<num>-threads_<num>-ranks/"
-   timers_csv_fn = glob.glob(base_path + '/pepper_diagnostics/*/timers.csv')
-   if len(timers_csv_fn) == 1:
-      timers_csv_fn = timers_csv_fn[0]
-      timers = pd.read_csv(timers_csv_fn)
-      timers['Task'] = timers['Task'].apply(lambda x: x.strip())
-      # Remove padding from column names
-      timers.columns = timers.columns.str.strip()
-      return {
-         'Total Runtime':                 timers.loc[timers['Task'] == 'Total','Duration [s]'].iloc[0],
-         'Event Generation Runtime':      timers.loc[timers['Task'] == 'Event generation','Duration [s]'].iloc[0],
-         'Optimisation Runtime':          timers.loc[timers['Task'] == 'Optimisation','Duration [s]'].iloc[0],
-         'Initialisation Runtime':        timers.loc[timers['Task'] == 'Initialisation','Duration [s]'].iloc[0],
-         'HDF5 Close Runtime':            timers.loc[timers['Task'] == 'HDF5 close','Duration [s]'].iloc[0],
-         'Unweighting Setup Runtime':     timers.loc[timers['Task'] == 'Unweighting setup','Duration [s]'].iloc[0],
-         'EG Recursion':                  timers.loc[timers['Task'] == 'Recursion','Duration [s]'].iloc[0],
-         'EG Output':                     timers.loc[timers['Task'] == 'Output','Duration [s]'].iloc[0],
-         'EG PDF and AlphaS evaluation':  timers.loc[timers['Task'] == 'PDF and AlphaS evaluation','Duration [s]'].iloc[0],
-         'EG Phase space':                timers.loc[timers['Task'] == 'Phase space','Duration [s]'].iloc[0],
-         'EG Output':                     timers.loc[timers['Task'] == 'Output','Duration [s]'].iloc[0],
-         'EG-R Calculate currents':       timers.loc[timers['Task'] == 'Calculate currents','Duration [s]'].iloc[0],
-         'EG-R Momenta preparation':      timers.loc[timers['Task'] == 'Momenta preparation','Duration [s]'].iloc[0],
-         'EG-R Currents preparation':     timers.loc[timers['Task'] == 'Currents preparation','Duration [s]'].iloc[0],
-         'EG-R IP reset':                 timers.loc[timers['Task'] == 'Internal particle information reset','Duration [s]'].iloc[0],
-         'EG-R ME update':                timers.loc[timers['Task'] == 'ME update','Duration [s]'].iloc[0],
-         'EG-R ME2 update':               timers.loc[timers['Task'] == 'ME2 update','Duration [s]'].iloc[0],
-         'EG-R ME reset':                 timers.loc[timers['Task'] == 'ME reset','Duration [s]'].iloc[0],
-         'EG-R IC reset':                 timers.loc[timers['Task'] == 'Internal currents reset','Duration [s]'].iloc[0],
-         'CSV Timer Filename':            timers_csv_fn,
-      }
-   
+   # with one timers.csv per rank the timers are those of the rank with the longest
+   # event generation (or total) time, "Event Generation Imbalance" (or "Total Imbalance")
+   # the max/mean of that time across ranks
+   if timer_columns is None:
+      timer_columns = TIMER_COLUMNS
+   timers_csv_fns = sorted(glob.glob(base_path + '/pepper_diagnostics/*/timers.csv'))
+   if len(timers_csv_fns) == 1:
+      timers_dict = read_timers_csv(timers_csv_fns[0],timer_columns)
+      timers_dict['CSV Timer Filename'] = timers_csv_fns[0]
+      return timers_dict
+   if len(timers_csv_fns) > 1:
+      timers = pd.DataFrame([read_timers_csv(fn,timer_columns) for fn in timers_csv_fns],index=timers_csv_fns)
+      # one rank's row rather than per-timer maxima, so the runtime breakdown still adds up
+      key = next((column for column in ('Event Generation Runtime','Total Runtime') if column in timers),None)
+      slowest = timers[key].idxmax() if key is not None else timers_csv_fns[0]
+      timers_dict = timers.loc[slowest].dropna().to_dict()
+      timers_dict['N Timer Files'] = len(timers_csv_fns)
+      if key is not None:
+         timers_dict[key.replace(' Runtime',' Imbalance')] = timers[key].max() / timers[key].mean()
+      timers_dict['CSV Timer Filename'] = slowest
+      return timers_dict
+
    return {}
 
 
+def read_timers_csv(timers_csv_fn, timer_columns):
+   # {result column: duration} of one timers.csv
+   timers = pd.read_csv(timers_csv_fn)
+   # Remove padding from column names
+   timers.columns = timers.columns.str.strip()
+   # index the durations by task in one pass, keeping the first entry of a repeated task
+   durations = pd.Series(timers['Duration [s]'].values,index=timers['Task'].str.strip())
+   durations = durations[~durations.index.duplicated()]
+   durations.index = [timer_columns.get(task,'Timer ' + task) for task in durations.index]
+   return durations.to_dict()
+
+
+def extract_rank_profile(base_path):
+   # base_path: "/path/to/output/{threads,ranks}/<num>-threads_<num>-ranks/"
+   # imbalance metrics of the rank_profiler.py profile, if the run was profiled
+   records,filename = rank_profiler.load_profile(base_path)
+   if not records:
+      return {}
+   profile_dict = rank_profiler.summarize(records)
+   profile_dict['Rank Profile Filename'] = filename
+   return profile_dict
+
+
 if __name__ == "__main__":
    main()
@@ -0,0 +1,257 @@
+''' Per-rank profiling around the MPI launch.
+
+"rank_profiler.py run" goes between mpiexec/srun and the executable and runs
+once per rank: it starts the executable, samples its CPU and memory use (and
+with --gpu the utilisation of the rank's GPU from nvidia-smi) every
+--interval seconds and, when it exits, writes the rank's wall time, hostname,
+exit code, CPU times, peak memory and samples to <output>/rank_<rank>.json.
+"rank_profiler.py merge" runs after the launch and packs the per-rank files
+into one <output>.json.gz per job. Only the standard library is used, it
+runs with whatever python3 the job environment provides.
+
+The run templates call it through the {profile_launch} and {profile_collect}
+options that Scheduler.point_opts fills in from the config "profile" block:
+   interval   seconds between samples (default 10, 0 disables sampling)
+   gpu        also sample GPU utilisation and memory (default false)
+   python     interpreter running the profiler on the compute nodes (default "python3")
+plotter.py reduces the profile of every run with summarize() to imbalance
+columns and draws the per-rank heatmap.
+'''
+import argparse
+import glob
+import gzip
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+PROFILE_NAME = 'rank_profile'
+# environment variables holding the rank of a process, by launcher
+RANK_VARIABLES = ['PMI_RANK','PALS_RANKID','PMIX_RANK','OMPI_COMM_WORLD_RANK','SLURM_PROCID']
+LOCAL_RANK_VARIABLES = ['PALS_LOCAL_RANKID','MPI_LOCALRANKID','OMPI_COMM_WORLD_LOCAL_RANK','SLURM_LOCALID']
+GPU_QUERY = ['nvidia-smi','--query-gpu=utilization.gpu,memory.used','--format=csv,noheader,nounits']
+
+
+def main():
+   parser = argparse.ArgumentParser(description='Per-rank profiling wrapper for MPI launches.')
+   subparsers = parser.add_subparsers(dest='command',required=True)
+   run_parser = subparsers.add_parser('run',help='run one rank of the executable and record its profile')
+   run_parser.add_argument('-o','--output',default=PROFILE_NAME,help='directory collecting the per-rank files')
+   run_parser.add_argument('--interval',type=float,default=10.,help='seconds between CPU/memory samples, 0 disables sampling')
+   run_parser.add_argument('--gpu',action='store_true',default=False,help="also sample the rank's GPU with nvidia-smi")
+   run_parser.add_argument('executable',nargs=argparse.REMAINDER,help='executable and its arguments, after "--"')
+   merge_parser = subparsers.add_parser('merge',help='pack the per-rank files into one compressed profile')
+   merge_parser.add_argument('output',nargs='?',default=PROFILE_NAME,help='directory collecting the per-rank files')
+   args = parser.parse_args()
+
+   if args.command == 'run':
+      executable = args.executable[1:] if args.executable[:1] == ['--'] else args.executable
+      if not executable:
+         parser.error('run needs an executable')
+      sys.exit(run(executable,args.output,args.interval,args.gpu))
+   else:
+      records = merge(args.output)
+      print(f'merged {len(records)} rank profiles into {args.output}.json.gz')
+
+
+def env_int(variables, default=None):
+   for variable in variables:
+      value = os.environ.get(variable)
+      if value is not None and value.isdigit():
+         return int(value)
+   return default
+
+
+def run(executable, output, interval=10., gpu=False):
+   # runs on every rank, returns the exit code of the executable
+   rank = env_int(RANK_VARIABLES,0)
+   local_rank = env_int(LOCAL_RANK_VARIABLES,rank)
+   record = {
+      'rank': rank,
+      'local_rank': local_rank,
+      'host': socket.gethostname(),
+      'start': time.time(),
+   }
+   start = time.monotonic()
+   process = subprocess.Popen(executable)
+   # pass the scheduler's termination on to the executable and still write the profile
+   for signum in (signal.SIGTERM,signal.SIGINT):
+      signal.signal(signum,lambda signum,frame: forward_signal(process.pid,signum))
+   sampler = Sampler(process.pid,start,interval,gpu_index(local_rank) if gpu else None)
+   if interval > 0:
+      sampler.start()
+   # wait4 gives the usage of the executable alone, without the nvidia-smi queries
+   while True:
+      try:
+         _,status,usage = os.wait4(process.pid,0)
+         break
+      except InterruptedError:
+         continue
+   process.returncode = returncode = os.waitstatus_to_exitcode(status)
+   sampler.stop()
+   record.update({
+      'wall': time.monotonic() - start,
+      'end': time.time(),
+      'exit_code': returncode,
+      'cpu_user': usage.ru_utime,
+      'cpu_system': usage.ru_stime,
+      # ru_maxrss is in kB on Linux
+      'max_rss_mb': usage.ru_maxrss / 1024.,
+      'samples': sampler.samples,
+   })
+   os.makedirs(output,exist_ok=True)
+   filename = os.path.join(output,f'rank_{rank:06d}.json')
+   with open(filename + '.tmp','w') as f:
+      json.dump(record,f,separators=(',',':'))
+   os.replace(filename + '.tmp',filename)
+   return returncode if returncode >= 0 else 128 - returncode
+
+
+def forward_signal(pid, signum):
+   # os.kill rather than Popen.send_signal, which may reap the child behind wait4
+   try:
+      os.kill(pid,signum)
+   except ProcessLookupError:
+      pass
+
+
+def gpu_index(local_rank):
+   # the GPU a rank runs on: the first one it sees, else one per local rank
+   visible = os.environ.get('CUDA_VISIBLE_DEVICES')
+   if visible:
+      return visible.split(',')[0]
+   return str(local_rank)
+
+
+class Sampler(threading.Thread):
+   ''' Samples CPU and memory use of a process from /proc, and GPU use from
+       nvidia-smi, every interval seconds, kept as one list per quantity. '''
+
+   def __init__(self, pid, start, interval, gpu=None):
+      super().__init__(daemon=True)
+      self.pid = pid
+      self.start_time = start
+      self.interval = interval
+      self.stopped = threading.Event()
+      self.gpu = gpu if gpu is not None and shutil.which(GPU_QUERY[0]) else None
+      self.ticks_per_second = os.sysconf('SC_CLK_TCK')
+      self.page_size = os.sysconf('SC_PAGE_SIZE')
+      self.last = None
+      self.samples = {'time': [], 'cpu_percent': [], 'rss_mb': []}
+      if self.gpu is not None:
+         self.samples.update({'gpu_percent': [], 'gpu_memory_mb': []})
+
+   def run(self):
+      while not self.stopped.wait(self.interval):
+         self.sample(time.monotonic() - self.start_time)
+
+   def stop(self):
+      self.stopped.set()
+      if self.is_alive():
+         self.join()
+
+   def sample(self, elapsed):
+      try:
+         with open(f'/proc/{self.pid}/stat') as f:
+            # fields after the command name, which may contain spaces
+            fields = f.read().rpartition(')')[2].split()
+         with open(f'/proc/{self.pid}/statm') as f:
+            resident_pages = int(f.read().split()[1])
+      except (OSError,IndexError,ValueError):
+         return
+      # utime + stime + cutime + cstime
+      cpu = sum(int(value) for value in fields[11:15]) / self.ticks_per_second
+      cpu_percent = 100. * (cpu - self.last[1]) / (elapsed - self.last[0]) if self.last and elapsed > self.last[0] else 0.
+      self.last = (elapsed,cpu)
+      self.samples['time'].append(round(elapsed,2))
+      self.samples['cpu_percent'].append(round(cpu_percent,1))
+      self.samples['rss_mb'].append(round(resident_pages * self.page_size / 2**20,1))
+      if self.gpu is not None:
+         utilisation,memory = self.query_gpu()
+         self.samples['gpu_percent'].append(utilisation)
+         self.samples['gpu_memory_mb'].append(memory)
+
+   def query_gpu(self):
+      try:
+         result = subprocess.run(GPU_QUERY + ['-i',self.gpu],capture_output=True,text=True,timeout=10)
+         utilisation,memory = result.stdout.split(',')
+         return float(utilisation),float(memory)
+      except (OSError,subprocess.TimeoutExpired,ValueError):
+         return None,None
+
+
+def merge(output):
+   # pack <output>/rank_*.json into <output>.json.gz and remove them, returns the records
+   records = load_rank_files(output)
+   with gzip.open(output + '.json.gz','wt') as f:
+      json.dump({'ranks': records},f,separators=(',',':'))
+   shutil.rmtree(output,ignore_errors=True)
+   return records
+
+
+def load_rank_files(output):
+   records = []
+   for filename in sorted(glob.glob(os.path.join(output,'rank_*.json'))):
+      try:
+         with open(filename) as f:
+            records.append(json.load(f))
+      except (OSError,ValueError):
+         print('ignoring unreadable rank profile: ',filename)
+   return sorted(records,key=lambda record: record['rank'])
+
+
+def load_profile(base_path, name=PROFILE_NAME):
+   ''' Rank records of a run and the file they came from: the merged
+       <name>.json.gz, or the per-rank files of a job that ended before the
+       merge. Returns [], None if the run was not profiled. '''
+   filename = os.path.join(base_path,name + '.json.gz')
+   if os.path.exists(filename):
+      with gzip.open(filename,'rt') as f:
+         return json.load(f)['ranks'],filename
+   directory = os.path.join(base_path,name)
+   if os.path.isdir(directory):
+      return load_rank_files(directory),directory
+   return [],None
+
+
+def summarize(records):
+   ''' Imbalance metrics of one run from its rank records: rank wall times
+       (min, mean, max, max/mean), the slowest rank and its host, the slowest
+       host's mean over the overall mean, CPU utilisation, peak memory and
+       mean GPU utilisation if it was sampled. '''
+   if not records:
+      return {}
+   walls = [record['wall'] for record in records]
+   mean = sum(walls) / len(walls)
+   straggler = max(records,key=lambda record: record['wall'])
+   hosts = {}
+   for record in records:
+      hosts.setdefault(record['host'],[]).append(record['wall'])
+   host_means = [sum(values) / len(values) for values in hosts.values()]
+   utilisation = [(record['cpu_user'] + record['cpu_system']) / record['wall'] for record in records if record['wall'] > 0]
+   summary = {
+      'Rank Runtime Min': min(walls),
+      'Rank Runtime Mean': mean,
+      'Rank Runtime Max': max(walls),
+      'Rank Imbalance': max(walls) / mean if mean > 0 else float('nan'),
+      'Straggler Rank': straggler['rank'],
+      'Straggler Host': straggler['host'],
+      'Node Imbalance': max(host_means) / mean if mean > 0 else float('nan'),
+      'N Hosts': len(hosts),
+      'Failed Ranks': sum(record['exit_code'] != 0 for record in records),
+      'Rank CPU Utilisation': sum(utilisation) / len(utilisation) if utilisation else float('nan'),
+      'Rank Max RSS [MB]': max(record['max_rss_mb'] for record in records),
+   }
+   gpu = [value for record in records for value in record['samples'].get('gpu_percent',[]) if value is not None]
+   if gpu:
+      summary['Rank GPU Utilisation'] = sum(gpu) / len(gpu)
+   return summary
+
+
+if __name__ == '__main__':
+   main()
@@ -0,0 +1,59 @@
+''' Columnar store for extracted scaling results.
+
+A store is a directory of Parquet files with one partition per sweep, e.g.
+"<output_basename>ranks.parquet/<sweep key>.parquet". Appending a sweep only
+writes its own partition, and loading can be restricted to a set of columns
+and/or partitions.
+'''
+import glob
+import os
+import re
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+PARTITION_COLUMN = 'Partition'
+
+
+def partition_key(path):
+   # turn a sweep input path into a filesystem friendly partition name
+   key = re.sub(r'[^A-Za-z0-9._-]+','_',os.path.abspath(path)).strip('_')
+   return key or 'default'
+
+
+def list_partitions(store_path):
+   return [os.path.basename(fn)[:-len('.parquet')] for fn in sorted(glob.glob(os.path.join(store_path,'*.parquet')))]
+
+
+def append_results(store_path, df, key):
+   # write df as partition 'key', replacing only that partition if it already exists
+   os.makedirs(store_path,exist_ok=True)
+   filename = os.path.join(store_path,key + '.parquet')
+   tmp_filename = filename + '.tmp'
+   table = pa.Table.from_pandas(df.drop(columns=[PARTITION_COLUMN],errors='ignore'),preserve_index=False)
+   pq.write_table(table,tmp_filename)
+   os.replace(tmp_filename,filename)
+   return filename
+
+
+def load_results(store_path, columns=None, keys=None):
+   # read the given partitions (default all) of a store into one DataFrame,
+   # only reading the requested columns that each partition actually has
+   if keys is None:
+      keys = list_partitions(store_path)
+   frames = []
+   for key in keys:
+      filename = os.path.join(store_path,key + '.parquet')
+      if not os.path.exists(filename):
+         continue
+      read_columns = None
+      if columns is not None:
+         available = pq.ParquetFile(filename).schema_arrow.names
+         read_columns = [column for column in columns if column in available]
+      df = pq.read_table(filename,columns=read_columns).to_pandas()
+      if columns is None or PARTITION_COLUMN in columns:
+         df[PARTITION_COLUMN] = key
+      frames.append(df)
+   if len(frames) == 0:
+      return pd.DataFrame(columns=columns)
+   return pd.concat(frames,ignore_index=True)
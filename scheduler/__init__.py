@@ -1 +1,4 @@
-from .pbs import PBS
\ No newline at end of file
+from .sched_base import Scheduler, JobStatus, RenderedScript
+from .pbs import PBS
+from .local import Local
+from .slurm import SLURM
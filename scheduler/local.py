@@ -0,0 +1,196 @@
+from .sched_base import JobStatus, QUEUED, RUNNING, FINISHED, parse_walltime
+from .pbs import PBS
+import subprocess
+import logging
+import signal
+import socket
+import time
+import os
+import re
+logger = logging.getLogger(__name__)
+
+PBS_DIRECTIVE_RE = re.compile(r'^#PBS\s+(.*)$',re.MULTILINE)
+# PBS reports jobs killed by a signal as 256 + signal number
+SIGNAL_EXIT_OFFSET = 256
+# seconds between SIGTERM and SIGKILL for jobs over their walltime
+KILL_GRACE_SECONDS = 30
+
+
+class LocalJob:
+   ''' One job script run as a subprocess of the submit loop. '''
+
+   def __init__(self, job_id, script_name, job_working_path, job_name, num_nodes, walltime, array_index=None):
+      self.job_id = job_id
+      self.array_index = array_index
+      self.script_name = script_name
+      self.job_working_path = job_working_path
+      self.job_name = job_name
+      self.num_nodes = num_nodes
+      self.walltime = walltime
+      self.process = None
+      self.cpus = []
+      self.state = QUEUED
+      self.exit_code = None
+      self.start_time = None
+      self.end_time = None
+      self.terminated = None
+
+   def status(self):
+      return JobStatus(self.job_id,self.state,self.exit_code,self.start_time,self.end_time)
+
+
+class Local(PBS):
+   ''' Runs the PBS job scripts on the current node instead of submitting them.
+
+       Jobs wait in a local queue until one of max_jobs slots and cpus_per_job
+       free cores are available, then run under bash pinned to their cores
+       with PBS_O_WORKDIR, PBS_JOBID, PBS_JOBNAME and a PBS_NODEFILE listing
+       this host once per requested node, writing "<job_name>.o<job id>" and
+       ".e<job id>" logs into their working directory. Jobs running past the
+       walltime in their "#PBS -l walltime" directive are killed. Bundles and
+       arrays use the PBS scripts, array elements run as separate local jobs
+       with their PBS_ARRAY_INDEX. Options come from the config "local" block:
+          max_jobs       jobs running at once (default 1)
+          cpus_per_job   cores pinned to each job (default: the available cores split over max_jobs)
+          pin            set the CPU affinity of each job (default true)
+   '''
+   SCRIPT_SUFFIX = '.local.sh'
+   DRIVEN_BY_POLLING = True
+
+   def __init__(self, poll_interval=30, max_jobs=1, cpus_per_job=None, pin=True):
+      super().__init__(poll_interval)
+      self.max_jobs = max(max_jobs,1)
+      self.cpus = sorted(os.sched_getaffinity(0)) if hasattr(os,'sched_getaffinity') else list(range(os.cpu_count()))
+      self.cpus_per_job = min(cpus_per_job or max(len(self.cpus) // self.max_jobs,1),len(self.cpus))
+      self.pin = pin and hasattr(os,'sched_setaffinity')
+      self.hostname = socket.gethostname()
+      self.jobs = {}
+      self.queue = []
+      self.next_job = 1
+
+   def submit_script(self, script_name, job_working_path, no_sub=False, array_size=None):
+      if no_sub:
+         return 0
+      with open(os.path.join(job_working_path,script_name)) as f:
+         directives = PBS_DIRECTIVE_RE.findall(f.read())
+      job_name = script_name
+      num_nodes = 1
+      walltime = None
+      for directive in directives:
+         match = re.match(r'-N\s+(\S+)',directive)
+         if match:
+            job_name = match.group(1)
+         for resources in re.findall(r'-l\s+(\S+)',directive):
+            for resource in resources.split(','):
+               key,_,value = resource.partition('=')
+               # "select=2:ncpus=64" chunks start with the node count
+               if key == 'select' and value.split(':')[0].isdigit():
+                  num_nodes = int(value.split(':')[0])
+               elif key == 'walltime':
+                  walltime = parse_walltime(value)
+
+      # the pid keeps job ids and log names of successive campaigns apart
+      job_id = f'{os.getpid()}_{self.next_job}'
+      self.next_job += 1
+      if array_size:
+         # "<id>[]" like qsub -J, elements "<id>[<index>]"
+         elements = [(self.array_element_id(job_id + '[]',index),index) for index in range(array_size)]
+         job_id += '[]'
+      else:
+         elements = [(job_id,None)]
+      for element_id,index in elements:
+         self.jobs[element_id] = LocalJob(element_id,script_name,os.path.abspath(job_working_path),job_name,num_nodes,walltime,index)
+         self.queue.append(element_id)
+         logger.debug('queued local job %s: %s in %s',element_id,script_name,job_working_path)
+      self.dispatch()
+      return job_id
+
+   def dispatch(self):
+      # reap finished jobs, kill jobs over their walltime and start queued jobs on free slots
+      now = time.time()
+      for job in self.jobs.values():
+         if job.state != RUNNING:
+            continue
+         returncode = job.process.poll()
+         if returncode is None and job.terminated is None and job.walltime and now - job.start_time > job.walltime:
+            logger.warning('local job %s exceeded its walltime of %d s, killing it',job.job_id,job.walltime)
+            self.kill(job)
+         elif returncode is None and job.terminated is not None and now - job.terminated > KILL_GRACE_SECONDS:
+            # jobs that ignore SIGTERM get SIGKILL on a later poll, the loop never blocks on them
+            logger.warning('local job %s did not stop %d s after SIGTERM, sending SIGKILL',job.job_id,KILL_GRACE_SECONDS)
+            self.kill(job,signal.SIGKILL)
+         if returncode is not None:
+            job.state = FINISHED
+            job.exit_code = returncode if returncode >= 0 else SIGNAL_EXIT_OFFSET - returncode
+            job.end_time = now
+            job.cpus = []
+
+      busy = [cpu for job in self.jobs.values() if job.state == RUNNING for cpu in job.cpus]
+      free = [cpu for cpu in self.cpus if cpu not in busy]
+      running = sum(job.state == RUNNING for job in self.jobs.values())
+      while self.queue and running < self.max_jobs and len(free) >= self.cpus_per_job:
+         job = self.jobs[self.queue.pop(0)]
+         job.cpus, free = free[:self.cpus_per_job], free[self.cpus_per_job:]
+         self.start(job)
+         running += 1
+
+   def start(self, job):
+      nodefile = os.path.join(job.job_working_path,f'nodefile.{job.job_id}')
+      with open(nodefile,'w') as f:
+         f.write((self.hostname + '\n') * job.num_nodes)
+      env = dict(os.environ,
+                 PBS_O_WORKDIR=job.job_working_path,
+                 PBS_NODEFILE=nodefile,
+                 PBS_JOBID=f'{job.job_id}.local',
+                 PBS_JOBNAME=job.job_name)
+      if job.array_index is not None:
+         env['PBS_ARRAY_INDEX'] = str(job.array_index)
+      cpus = job.cpus if self.pin else None
+      stdout = open(os.path.join(job.job_working_path,f'{job.job_name}.o{job.job_id}'),'w')
+      stderr = open(os.path.join(job.job_working_path,f'{job.job_name}.e{job.job_id}'),'w')
+      with stdout, stderr:
+         job.process = subprocess.Popen(['bash',job.script_name],cwd=job.job_working_path,env=env,
+                                        stdout=stdout,stderr=stderr,stdin=subprocess.DEVNULL,
+                                        start_new_session=True,
+                                        preexec_fn=(lambda: os.sched_setaffinity(0,cpus)) if cpus else None)
+      job.state = RUNNING
+      job.start_time = time.time()
+      logger.info('started local job %s on cpus %s: %s in %s',job.job_id,compact_cpus(job.cpus),job.script_name,job.job_working_path)
+
+   def kill(self, job, signum=signal.SIGTERM):
+      # the job runs in its own session, so this reaches everything it started
+      if signum == signal.SIGTERM:
+         job.terminated = time.time()
+      try:
+         os.killpg(job.process.pid,signum)
+      except ProcessLookupError:
+         pass
+
+   def query_status(self, job_ids):
+      self.dispatch()
+      # ids of other processes or earlier campaigns have left the queue like jobs PBS forgot
+      return {job_id: self.jobs[job_id].status() if job_id in self.jobs else JobStatus(job_id,FINISHED,None,None,None)
+              for job_id in job_ids}
+
+   def delete(self, job_id):
+      job = self.jobs.get(str(job_id))
+      if job is None or job.state == FINISHED:
+         return False
+      if job.state == QUEUED:
+         self.queue.remove(job.job_id)
+         job.state = FINISHED
+         job.end_time = time.time()
+         return True
+      self.kill(job)
+      return True
+
+
+def compact_cpus(cpus):
+   # [0, 1, 2, 5] -> "0-2,5"
+   ranges = []
+   for cpu in cpus:
+      if ranges and cpu == ranges[-1][1] + 1:
+         ranges[-1][1] = cpu
+      else:
+         ranges.append([cpu,cpu])
+   return ','.join(str(a) if a == b else f'{a}-{b}' for a,b in ranges)
@@ -1,64 +1,161 @@
-from .sched_base import Scheduler
+from .sched_base import Scheduler, JobStatus, QUEUED, RUNNING, EXITING, FINISHED, UNKNOWN, format_walltime, parse_walltime
+from .template import load_template
 import subprocess
 import logging
+import json
+import time
 import os
+import shlex
 logger = logging.getLogger(__name__)
 
 
+TEMPLATE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'templates')
+
+
 class PBS(Scheduler):
+   SCRIPT_SUFFIX = '.pbs.sh'
+   SUBMIT = 'qsub'
+   STATUS = 'qstat'
+   DELETE = 'qdel'
+   BUNDLE_TEMPLATE_FILE = os.path.join(TEMPLATE_PATH,'bundle_polaris.sh')
+   ARRAY_TEMPLATE_FILE = os.path.join(TEMPLATE_PATH,'array_polaris.sh')
+   ARRAY_BODY = '\n'.join([
+      'cd $PBS_O_WORKDIR',
+      "IFS=$'\\t' read -r WORKDIR SCRIPT JOB_NAME < <(sed -n \"$((PBS_ARRAY_INDEX + 1))p\" {table})",
+      'JOB_NUMBER=${{PBS_JOBID%%[*}}',
+      'cd "$WORKDIR" && PBS_O_WORKDIR="$WORKDIR" bash "$SCRIPT" > "$JOB_NAME.o$JOB_NUMBER.$PBS_ARRAY_INDEX" 2>&1',
+      'POINT_STATUS=$?',
+   ])
+   # PBS job_state letters
+   JOB_STATES = {
+      'Q': QUEUED, 'H': QUEUED, 'W': QUEUED, 'T': QUEUED, 'S': QUEUED, 'U': QUEUED, 'M': QUEUED,
+      'R': RUNNING, 'B': RUNNING,
+      'E': EXITING,
+      'F': FINISHED, 'X': FINISHED,
+   }
+
+   def submit_command(self, script_name, array_size=None):
+      # "qsub -J 0-<n-1>" submits an array job, subjobs see their index in PBS_ARRAY_INDEX
+      array = ['-J',f'0-{array_size - 1}'] if array_size else []
+      return [self.SUBMIT] + array + [script_name]
+
+   def parse_job_id(self, output):
+      # Extract job ID from the result (assuming the format is "1234.servername", "1234[].servername" for arrays)
+      return output.split('.')[0]
 
-   def submit(self, config,
-              threads: int,
-              ranks: int,
-              job_working_path: str = os.getcwd(),
-              no_sub: bool = False):
-      
-      
-      # open PBS script template
-      self.SUBMIT_SCRIPT = self.get_script(config['script_template_file'])
-      logging.debug("script template:\n%s",self.SUBMIT_SCRIPT)
-
-      # Create the PBS script
+   def array_element_id(self, job_id, index):
+      # "1234[]" -> "1234[<index>]"
+      return job_id.replace('[]',f'[{index}]')
+
+   def submit_bundle(self, config, scripts, bundle_path, no_sub=False):
+      ''' Pack several RenderedScripts into one PBS job.
+          Each point's script is written into its own working directory as for
+          submit() and run from there with its own node file and
+          "<job_name>.o<job number>" log. In "sequential" mode (default) the points
+          run one after another on the first nodes of the allocation, in
+          "concurrent" mode every point gets its own nodes, or one of
+          bundle_slots_per_node GPU slots of a shared node if it needs a single
+          node. '''
+      mode = config.get('bundle_mode','sequential')
+      if mode not in ('sequential','concurrent'):
+         raise ValueError(f"Unsupported bundle_mode: {mode}")
+      slots_per_node = config.get('bundle_slots_per_node',1)
       opts = config['script_template_opts']
-      opts['threads'] = threads
-      opts['ranks'] = ranks
-      opts['num_nodes'] = int(ranks / opts['ranks_per_node'])
-      script_content = self.SUBMIT_SCRIPT.format(**opts)
-      logging.debug("script file:\n%s",script_content)
-
-      # make sure output path exists
-      os.makedirs(job_working_path,exist_ok=True)
-
-      script_name = f"{threads:06d}-threads_{ranks:05d}-ranks.pbs.sh"
-      script_path = os.path.join(job_working_path,script_name)
-      with open(script_path, 'w') as f:
+      bundle_template = load_template(config.get('bundle_template_file',self.BUNDLE_TEMPLATE_FILE))
+
+      # BUNDLE_STATUS is the exit code of the last failed point, 0 if all succeeded
+      body = ['cd $PBS_O_WORKDIR','JOB_NUMBER=${PBS_JOBID%%.*}','BUNDLE_STATUS=0','']
+      next_node = 0
+      max_nodes = 0
+      shared_node = None
+      shared_slot = slots_per_node
+      for script in scripts:
+         num_nodes = max(script.opts['num_nodes'],1)
+         max_nodes = max(max_nodes,num_nodes)
+         env = ''
+         if mode == 'sequential':
+            first_node = 0
+         elif slots_per_node > 1 and num_nodes == 1:
+            # share a node between single node points, one GPU slot each
+            if shared_slot == slots_per_node:
+               shared_node = next_node
+               shared_slot = 0
+               next_node += 1
+            first_node = shared_node
+            env = f'CUDA_VISIBLE_DEVICES={shared_slot} '
+            shared_slot += 1
+         else:
+            first_node = next_node
+            next_node += num_nodes
+
+         job_working_path = os.path.abspath(script.job_working_path)
+         path = shlex.quote(job_working_path)
+         nodefile = shlex.quote(os.path.join(job_working_path,'nodefile'))
+         log = shlex.quote(os.path.join(job_working_path,script.opts['job_name'])) + '.o$JOB_NUMBER'
+         body.append(f'# {script.threads} threads {script.ranks} ranks')
+         body.append(f"sed -n '{first_node + 1},{first_node + num_nodes}p' $PBS_NODEFILE > {nodefile}")
+         run = f'(cd {path} && {env}PBS_O_WORKDIR={path} PBS_NODEFILE={nodefile} bash {shlex.quote(script.script_name)}) > {log} 2>&1'
+         if mode == 'concurrent':
+            body.append(run + ' &')
+            body.append('PIDS="$PIDS $!"')
+         else:
+            body.append(run + ' || BUNDLE_STATUS=$?')
+      if mode == 'concurrent':
+         body.append('for PID in $PIDS; do wait $PID || BUNDLE_STATUS=$?; done')
+
+      bundle_opts = dict(opts)
+      bundle_opts['num_nodes'] = next_node if mode == 'concurrent' else max_nodes
+      bundle_opts['walltime'] = config.get('bundle_walltime') or bundle_walltime(scripts,mode)
+      bundle_opts['body'] = '\n'.join(body)
+      script_content = bundle_template.render(bundle_opts)
+
+      for script in scripts:
+         self.write_script(script)
+      os.makedirs(bundle_path,exist_ok=True)
+      script_name = 'bundle' + self.SCRIPT_SUFFIX
+      with open(os.path.join(bundle_path,script_name),'w') as f:
          f.write(script_content)
+      return self.submit_script(script_name,bundle_path,no_sub)
+
+   def query_status(self, job_ids):
+      # one "qstat -x -t -f -F json" call for all jobs, -x keeps finished jobs in the answer, -t lists array subjobs
+      cmd = [self.STATUS,'-x','-t','-f','-F','json'] + list(job_ids)
+      result = subprocess.run(cmd, capture_output=True, text=True)
+      try:
+         jobs = json.loads(result.stdout)['Jobs'] if result.stdout.strip() else {}
+      except (ValueError,KeyError) as e:
+         logger.warning('could not parse qstat output (exit code %d): %s %s',result.returncode,e,result.stderr)
+         return {}
+
+      statuses = {}
+      for full_job_id,info in jobs.items():
+         # "1234.servername" -> "1234", matching what submit returns
+         job_id = full_job_id.split('.')[0]
+         statuses[job_id] = JobStatus(job_id,
+                                      self.JOB_STATES.get(info.get('job_state'),UNKNOWN),
+                                      info.get('Exit_status'),
+                                      self.parse_time(info.get('stime')),
+                                      self.parse_time(info.get('obittime')))
+      # ids that dropped out of the job history have left the queue as well
+      for line in result.stderr.splitlines():
+         if 'Unknown Job Id' in line:
+            job_id = line.split('Unknown Job Id')[1].strip().split('.')[0]
+            statuses[job_id] = JobStatus(job_id,FINISHED,None,None,None)
+      return statuses
+
+   @staticmethod
+   def parse_time(value):
+      # qstat reports times like "Mon Oct 16 12:00:00 2023"
+      if not value:
+         return None
+      try:
+         return time.mktime(time.strptime(value,'%a %b %d %H:%M:%S %Y'))
+      except ValueError:
+         return None
+
 
-      # Submit the job
-      cmd = f"{self.SUBMIT} {script_name}"
-      logger.debug("submit command: %s",cmd)
-      if not no_sub:
-         result = subprocess.run(cmd, capture_output=True, shell=True, text=True,cwd=job_working_path)
-
-         if result.returncode != 0:
-            open(os.path.join(job_working_path,script_name + '.output.txt'),'w').write(result.stdout)
-            open(os.path.join(job_working_path,script_name + '.error.txt'),'w').write(result.stderr)
-
-         # Extract job ID from the result (assuming the format is "1234.servername")
-         job_id = result.stdout.split('.')[0]
-         return job_id
-      else:
-         return 0
-   
-   def get_script(self,script_template_file):
-      return open(script_template_file).read()
-
-   def status(self, job_id):
-      cmd = f"{self.STATUS} {job_id}"
-      result = subprocess.run(cmd, capture_output=True, shell=True, text=True)
-      return job_id in result.stdout
-
-   def delete(self, job_id):
-      cmd = f"{self.DELETE} {job_id}"
-      result = subprocess.run(cmd, capture_output=True, shell=True, text=True)
-      return result.returncode == 0
+def bundle_walltime(scripts, mode):
+   # sequential points run one after another and need the sum of their walltimes, concurrent ones the longest
+   walltimes = [parse_walltime(script.opts.get('walltime')) or 0 for script in scripts]
+   seconds = sum(walltimes) if mode == 'sequential' else max(walltimes)
+   return format_walltime(seconds)
@@ -1,17 +1,212 @@
+import collections
+import logging
+import os
+import shlex
+import subprocess
+import time
+from .template import load_template, freeze
+logger = logging.getLogger(__name__)
+
+PROFILER_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'rank_profiler.py')
+
+# scheduler independent job states reported by Scheduler.status_many
+QUEUED = 'queued'
+RUNNING = 'running'
+EXITING = 'exiting'
+FINISHED = 'finished'
+UNKNOWN = 'unknown'  # the scheduler could not be asked, assume the job is still there
+
+
+class JobStatus(collections.namedtuple('JobStatus',['job_id','state','exit_code','start_time','end_time'])):
+   ''' state of one job, start_time/end_time are epoch seconds or None '''
+
+   @property
+   def active(self):
+      return self.state != FINISHED
+
+
+class RenderedScript(collections.namedtuple('RenderedScript',['threads','ranks','job_working_path','script_name','content','opts'])):
+   ''' job script of one sweep point, rendered and validated but not yet written '''
+
+
 class Scheduler:
    SUBMIT_SCRIPT = ''
-   SUBMIT = 'qsub'
-   STATUS = 'qstat'
-   DELETE = 'qdel'
+   SCRIPT_SUFFIX = '.sh'
+   SUBMIT = None
+   STATUS = None
+   DELETE = None
+   # header template of array jobs and the body that runs one line of the
+   # array's point table, formatted with the shell quoted {table} filename and
+   # leaving the point's exit code in POINT_STATUS for the template to exit with
+   ARRAY_TEMPLATE_FILE = None
+   ARRAY_BODY = None
+   # True if jobs only start and finish while the submit loop polls their status
+   DRIVEN_BY_POLLING = False
+
+   def __init__(self, poll_interval=30):
+      # status answers are reused for poll_interval seconds
+      self.poll_interval = poll_interval
+      self._status_cache = {}
+      self._status_time = None
+
+   def submit(self, config,
+              threads: int,
+              ranks: int,
+              job_working_path: str = os.getcwd(),
+              no_sub: bool = False,
+              overrides: dict = None):
+
+      script = self.render(config,threads,ranks,job_working_path,overrides)
+      return self.submit_rendered(script,no_sub)
+
+   def submit_rendered(self, script, no_sub=False):
+      # write a RenderedScript into its working directory and submit it
+      self.write_script(script)
+      return self.submit_script(script.script_name,script.job_working_path,no_sub)
+
+   def submit_script(self, script_name, job_working_path, no_sub=False, array_size=None):
+      # Submit the job, as an array of array_size elements if given
+      cmd = self.submit_command(script_name,array_size)
+      logger.debug("submit command: %s",shlex.join(cmd))
+      if not no_sub:
+         result = subprocess.run(cmd, capture_output=True, text=True,cwd=job_working_path)
+
+         if result.returncode != 0:
+            open(os.path.join(job_working_path,script_name + '.output.txt'),'w').write(result.stdout)
+            open(os.path.join(job_working_path,script_name + '.error.txt'),'w').write(result.stderr)
+
+         return self.parse_job_id(result.stdout)
+      else:
+         return 0
+
+   def submit_command(self, script_name, array_size=None):
+      raise NotImplementedError("submit_command function is not defined for this scheduler")
+
+   def parse_job_id(self, output):
+      raise NotImplementedError("parse_job_id function is not defined for this scheduler")
+
+   def submit_bundle(self, config, scripts, bundle_path, no_sub=False):
+      raise NotImplementedError("bundle_size > 1 is not supported by this scheduler")
+
+   def submit_array(self, config, scripts, array_path, no_sub=False):
+      ''' Submit RenderedScripts requesting the same nodes and walltime as one
+          array job: each script is written into its working directory as for
+          submit() and array element i runs line i of a point table from
+          there, with a "<job_name>.o<job id>" log. Returns the job ids of the
+          elements in the order of scripts. '''
+      for script in scripts:
+         self.write_script(script)
+      os.makedirs(array_path,exist_ok=True)
+      table = os.path.join(os.path.abspath(array_path),'array_points.tsv')
+      with open(table,'w') as f:
+         for script in scripts:
+            f.write('\t'.join([os.path.abspath(script.job_working_path),script.script_name,script.opts['job_name']]) + '\n')
+
+      array_template = load_template(config.get('array_template_file',self.ARRAY_TEMPLATE_FILE))
+      array_opts = dict(config['script_template_opts'])
+      array_opts['num_nodes'] = scripts[0].opts['num_nodes']
+      array_opts['walltime'] = scripts[0].opts['walltime']
+      array_opts['body'] = self.ARRAY_BODY.format(table=shlex.quote(table))
+      script_name = 'array' + self.SCRIPT_SUFFIX
+      with open(os.path.join(array_path,script_name),'w') as f:
+         f.write(array_template.render(array_opts))
+      job_id = self.submit_script(script_name,array_path,no_sub,len(scripts))
+      if not job_id:
+         return [job_id] * len(scripts)
+      return [self.array_element_id(job_id,index) for index in range(len(scripts))]
+
+   def array_element_id(self, job_id, index):
+      raise NotImplementedError("array_element_id function is not defined for this scheduler")
+
+   def point_opts(self, config, threads, ranks, overrides=None):
+      # template options for one point, overrides replace script_template_opts entries
+      opts = dict(config['script_template_opts'])
+      if overrides:
+         opts.update(overrides)
+      opts['threads'] = threads
+      opts['ranks'] = ranks
+      ranks_per_node = opts.get('ranks_per_node',1)
+      if not isinstance(ranks,int) or not isinstance(ranks_per_node,int) or ranks_per_node <= 0:
+         raise ValueError(f'ranks={ranks!r} and ranks_per_node={ranks_per_node!r} must be integers')
+      if ranks % ranks_per_node != 0:
+         raise ValueError(f'ranks={ranks} is not a multiple of ranks_per_node={ranks_per_node}')
+      opts['num_nodes'] = ranks // ranks_per_node
+      opts.update(profile_opts(config.get('profile')))
+      return freeze(opts)
+
+   def render(self, config, threads, ranks, job_working_path, overrides=None):
+      # render and validate the script of one point without touching the filesystem
+      template = load_template(config['script_template_file'])
+      opts = self.point_opts(config,threads,ranks,overrides)
+      script_content = template.render(opts)
+      logger.debug("script file:\n%s",script_content)
+      script_name = f"{threads:06d}-threads_{ranks:05d}-ranks" + self.SCRIPT_SUFFIX
+      return RenderedScript(threads,ranks,job_working_path,script_name,script_content,opts)
+
+   def render_all(self, config, points):
+      # render every (threads, ranks, job_working_path, overrides) point so a
+      # bad option fails the whole sweep before anything is submitted
+      return [self.render(config,threads,ranks,job_working_path,overrides) for threads,ranks,job_working_path,overrides in points]
+
+   def write_script(self, script):
+      # make sure output path exists
+      os.makedirs(script.job_working_path,exist_ok=True)
+      with open(os.path.join(script.job_working_path,script.script_name),'w') as f:
+         f.write(script.content)
+
+   def status(self, job_id):
+      # True while the job is queued or running
+      return self.status_many([job_id])[str(job_id)].active
+
+   def status_many(self, job_ids):
+      ''' returns {job_id: JobStatus} for all job_ids using a single scheduler query,
+          answers younger than poll_interval are served from the cache '''
+      job_ids = [str(job_id) for job_id in job_ids]
+      now = time.monotonic()
+      stale = self._status_time is None or now - self._status_time >= self.poll_interval
+      if stale or any(job_id not in self._status_cache for job_id in job_ids):
+         # refresh every job that is still tracked along with the requested ones
+         tracked = [job_id for job_id,status in self._status_cache.items() if status.active and job_id not in job_ids]
+         statuses = self.query_status(job_ids + tracked)
+         for job_id in job_ids + tracked:
+            self._status_cache[job_id] = statuses.get(job_id,JobStatus(job_id,UNKNOWN,None,None,None))
+         self._status_time = now
+      return {job_id: self._status_cache[job_id] for job_id in job_ids}
+
+   def query_status(self, job_ids):
+      raise NotImplementedError("query_status function is not defined for this scheduler")
+
+   def delete(self, job_id):
+      result = subprocess.run([self.DELETE,str(job_id)], capture_output=True, text=True)
+      return result.returncode == 0
+
+
+def profile_opts(profile=None):
+   # {profile_launch} goes between the MPI launcher and the executable, {profile_collect}
+   # after the launch, both are empty unless the config has a "profile" block
+   if profile is None:
+      return {'profile_launch': '', 'profile_collect': ''}
+   profiler = [profile.get('python','python3'),PROFILER_PATH]
+   launch = profiler + ['run','--interval',str(profile.get('interval',10))]
+   if profile.get('gpu',False):
+      launch.append('--gpu')
+   return {
+      'profile_launch': shlex.join(launch + ['--']) + ' ',
+      'profile_collect': shlex.join(profiler + ['merge']),
+   }
 
-   def __init__(self):
-      pass
 
-   def submit(self):
-      raise NotImplementedError("submit function is not defined for this scheduler")
+def format_walltime(seconds):
+   # seconds -> "HH:MM:SS"
+   seconds = int(seconds)
+   return f'{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}'
 
-   def status(self):
-      raise NotImplementedError("status function is not defined for this scheduler")
 
-   def delete(self):
-      raise NotImplementedError("delete function is not defined for this scheduler")
\ No newline at end of file
+def parse_walltime(walltime):
+   # "HH:MM:SS" -> seconds
+   if not walltime:
+      return None
+   seconds = 0
+   for part in str(walltime).split(':'):
+      seconds = seconds * 60 + int(part)
+   return seconds
@@ -0,0 +1,118 @@
+from .sched_base import Scheduler, JobStatus, QUEUED, RUNNING, EXITING, FINISHED, UNKNOWN
+import subprocess
+import logging
+import time
+import os
+logger = logging.getLogger(__name__)
+
+TEMPLATE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'templates')
+
+
+class SLURM(Scheduler):
+   SCRIPT_SUFFIX = '.slurm.sh'
+   SUBMIT = 'sbatch'
+   STATUS = 'squeue'
+   ACCOUNTING = 'sacct'
+   DELETE = 'scancel'
+   ARRAY_TEMPLATE_FILE = os.path.join(TEMPLATE_PATH,'array_slurm.sh')
+   ARRAY_BODY = '\n'.join([
+      'cd $SLURM_SUBMIT_DIR',
+      "IFS=$'\\t' read -r WORKDIR SCRIPT JOB_NAME < <(sed -n \"$((SLURM_ARRAY_TASK_ID + 1))p\" {table})",
+      'cd "$WORKDIR" && SLURM_SUBMIT_DIR="$WORKDIR" bash "$SCRIPT" > "$JOB_NAME.o${{SLURM_ARRAY_JOB_ID}}_$SLURM_ARRAY_TASK_ID" 2>&1',
+      'POINT_STATUS=$?',
+   ])
+   # squeue/sacct job states
+   JOB_STATES = {
+      'PENDING': QUEUED, 'CONFIGURING': QUEUED, 'REQUEUED': QUEUED, 'REQUEUE_HOLD': QUEUED,
+      'REQUEUE_FED': QUEUED, 'RESIZING': QUEUED, 'SUSPENDED': QUEUED, 'STOPPED': QUEUED,
+      'RUNNING': RUNNING, 'SIGNALING': RUNNING, 'STAGE_OUT': RUNNING,
+      'COMPLETING': EXITING,
+      'COMPLETED': FINISHED, 'FAILED': FINISHED, 'CANCELLED': FINISHED, 'TIMEOUT': FINISHED,
+      'NODE_FAIL': FINISHED, 'PREEMPTED': FINISHED, 'OUT_OF_MEMORY': FINISHED, 'BOOT_FAIL': FINISHED,
+      'DEADLINE': FINISHED, 'SPECIAL_EXIT': FINISHED, 'REVOKED': FINISHED,
+   }
+
+   # polls a job may go missing from a failing squeue and from sacct before it counts as finished
+   MAX_UNACCOUNTED_POLLS = 5
+
+   def __init__(self, poll_interval=30):
+      super().__init__(poll_interval)
+      self.unaccounted = {}
+
+   def submit_command(self, script_name, array_size=None):
+      # "sbatch --array=0-<n-1>" submits an array job, elements see their index in SLURM_ARRAY_TASK_ID
+      array = [f'--array=0-{array_size - 1}'] if array_size else []
+      return [self.SUBMIT,'--parsable'] + array + [script_name]
+
+   def parse_job_id(self, output):
+      # --parsable prints "1234" or "1234;cluster"
+      return output.strip().split(';')[0]
+
+   def array_element_id(self, job_id, index):
+      return f'{job_id}_{index}'
+
+   def query_status(self, job_ids):
+      # one squeue call for the jobs still queued or running, one sacct call
+      # for the ones that already left the queue
+      job_ids = list(job_ids)
+      statuses = {}
+      cmd = [self.STATUS,'-h','-r','-j',','.join(job_ids),'-o','%i|%T|%S']
+      result = subprocess.run(cmd, capture_output=True, text=True)
+      # squeue fails outright if none of the ids is known any more
+      queue_answered = result.returncode == 0 or 'Invalid job id' in result.stderr
+      if not queue_answered:
+         logger.warning('squeue failed (exit code %d): %s',result.returncode,result.stderr.strip())
+      for line in result.stdout.splitlines():
+         job_id,state,start = line.strip().split('|')
+         if job_id in job_ids:
+            statuses[job_id] = JobStatus(job_id,self.job_state(state),None,self.parse_time(start),None)
+
+      missing = [job_id for job_id in job_ids if job_id not in statuses]
+      if not missing:
+         return statuses
+      cmd = [self.ACCOUNTING,'-n','-P','-X','-j',','.join(missing),'--format=JobID,State,ExitCode,Start,End']
+      result = subprocess.run(cmd, capture_output=True, text=True)
+      if result.returncode != 0:
+         logger.warning('sacct failed (exit code %d): %s',result.returncode,result.stderr.strip())
+      for line in result.stdout.splitlines():
+         fields = line.strip().split('|')
+         if len(fields) != 5 or fields[0] not in missing:
+            continue
+         job_id,state,exit_code,start,end = fields
+         statuses[job_id] = JobStatus(job_id,self.job_state(state),self.parse_exit_code(exit_code),
+                                      self.parse_time(start),self.parse_time(end))
+      for job_id in missing:
+         if job_id in statuses:
+            self.unaccounted.pop(job_id,None)
+            continue
+         # without accounting, jobs that dropped out of squeue have left the queue as well;
+         # if squeue itself failed for another reason, give up on the job after a few polls
+         self.unaccounted[job_id] = self.unaccounted.get(job_id,0) + 1
+         if queue_answered or self.unaccounted[job_id] >= self.MAX_UNACCOUNTED_POLLS:
+            logger.warning('job %s is neither in squeue nor in sacct, assuming it finished',job_id)
+            statuses[job_id] = JobStatus(job_id,FINISHED,None,None,None)
+            del self.unaccounted[job_id]
+      return statuses
+
+   def job_state(self, state):
+      # "CANCELLED by 1234" -> "CANCELLED"
+      return self.JOB_STATES.get(state.split(' ')[0].rstrip('+'),UNKNOWN)
+
+   @staticmethod
+   def parse_exit_code(value):
+      # sacct reports "<exit code>:<signal>", jobs killed by a signal get 256 + signal as in PBS
+      code,_,signal = value.partition(':')
+      try:
+         code = int(code)
+         signal = int(signal or 0)
+      except ValueError:
+         return None
+      return 256 + signal if signal else code
+
+   @staticmethod
+   def parse_time(value):
+      # squeue/sacct report times like "2023-10-16T12:00:00", or "N/A", "Unknown", "None"
+      try:
+         return time.mktime(time.strptime(value,'%Y-%m-%dT%H:%M:%S'))
+      except ValueError:
+         return None
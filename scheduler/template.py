@@ -0,0 +1,58 @@
+import os
+import string
+import types
+
+
+class ScriptTemplate:
+   ''' A job script template parsed once: the placeholders it uses and their
+       format specs are known up front so options can be checked before
+       rendering. '''
+
+   def __init__(self, text, filename='<string>'):
+      self.text = text
+      self.filename = filename
+      # placeholder name -> set of format specs used with it
+      self.fields = {}
+      for _,field_name,format_spec,_ in string.Formatter().parse(text):
+         if field_name is None:
+            continue
+         name = field_name.split('.')[0].split('[')[0]
+         self.fields.setdefault(name,set()).add(format_spec)
+
+   def validate(self, opts):
+      # raises ValueError listing every missing option and every non-integer ':d' option
+      errors = []
+      missing = sorted(name for name in self.fields if name not in opts)
+      if missing:
+         errors.append('missing options ' + ', '.join(missing))
+      for name,specs in sorted(self.fields.items()):
+         if name in opts and any(spec.endswith('d') for spec in specs):
+            value = opts[name]
+            if isinstance(value,bool) or not isinstance(value,int):
+               errors.append(f'option {name}={value!r} must be an integer')
+      if errors:
+         raise ValueError(f'cannot render {self.filename}: ' + '; '.join(errors))
+
+   def render(self, opts):
+      self.validate(opts)
+      return self.text.format_map(opts)
+
+
+# filename -> (mtime, ScriptTemplate), templates are only re-read when they change
+_TEMPLATE_CACHE = {}
+
+
+def load_template(filename):
+   filename = os.path.abspath(filename)
+   mtime = os.stat(filename).st_mtime_ns
+   cached = _TEMPLATE_CACHE.get(filename)
+   if cached is None or cached[0] != mtime:
+      with open(filename) as f:
+         cached = (mtime,ScriptTemplate(f.read(),filename))
+      _TEMPLATE_CACHE[filename] = cached
+   return cached[1]
+
+
+def freeze(opts):
+   # read-only view of a per-point option set
+   return types.MappingProxyType(dict(opts))
@@ -0,0 +1,12 @@
+#/bin/bash
+#PBS -l select={num_nodes:d}
+#PBS -l walltime={walltime}
+#PBS -A {project}
+#PBS -q {queue}
+#PBS -l filesystems={filesystems}
+#PBS -N {job_name}_array
+
+echo [$SECONDS] array element $PBS_ARRAY_INDEX start
+{body}
+echo [$SECONDS] array element $PBS_ARRAY_INDEX done
+exit $POINT_STATUS
@@ -0,0 +1,12 @@
+#/bin/bash
+#SBATCH -N {num_nodes:d}
+#SBATCH -t {walltime}
+#SBATCH -A {project}
+#SBATCH -q {queue}
+#SBATCH -J {job_name}_array
+#SBATCH -o {job_name}_array.o%A_%a
+
+echo [$SECONDS] array element $SLURM_ARRAY_TASK_ID start
+{body}
+echo [$SECONDS] array element $SLURM_ARRAY_TASK_ID done
+exit $POINT_STATUS
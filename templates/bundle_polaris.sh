@@ -0,0 +1,12 @@
+#/bin/bash
+#PBS -l select={num_nodes:d}
+#PBS -l walltime={walltime}
+#PBS -A {project}
+#PBS -q {queue}
+#PBS -l filesystems={filesystems}
+#PBS -N {job_name}_bundle
+
+echo [$SECONDS] bundle start
+{body}
+echo [$SECONDS] bundle done
+exit $BUNDLE_STATUS
@@ -5,6 +5,7 @@
 #PBS -q {queue}
 #PBS -l filesystems={filesystems}
 #PBS -N {job_name}
+#PBS -k doe
 
 cd $PBS_O_WORKDIR
 
@@ -36,7 +37,7 @@ cat << EOF > pepper_config.ini
 process = {process}
 batch_size = {threads:d}
 n_batches = {n_batches:d}
-seed = 12345
+seed = {seed:d}
 collision_energy = 14000
 mu2 = H_T^2/2
 verbosity = info
@@ -74,5 +75,9 @@ cat << EOF > parallel_config.json
 EOF
 
 echo [$SECONDS] pepper start
-mpiexec -n $NRANKS --ppn $RANKS_PER_NODE --hostfile $PBS_NODEFILE $PEPPER_PATH/{executable} pepper_config.ini
+mpiexec -n $NRANKS --ppn $RANKS_PER_NODE --hostfile $PBS_NODEFILE {profile_launch}$PEPPER_PATH/{executable} pepper_config.ini
+PEPPER_STATUS=$?
 echo [$SECONDS] pepper done
+{profile_collect}
+# the exit code tells the campaign state whether the point has to be resubmitted
+exit $PEPPER_STATUS
@@ -0,0 +1,82 @@
+#/bin/bash
+#SBATCH -N {num_nodes:d}
+#SBATCH -t {walltime}
+#SBATCH -A {project}
+#SBATCH -q {queue}
+#SBATCH -J {job_name}
+#SBATCH -o {job_name}.o%j
+
+cd $SLURM_SUBMIT_DIR
+
+NUM_NODES=$SLURM_JOB_NUM_NODES
+RANKS_PER_NODE={ranks_per_node:d}
+NRANKS=$(( $NUM_NODES * $RANKS_PER_NODE ))
+echo [$SECONDS] running $NRANKS ranks on $NUM_NODES nodes
+echo [$SECONDS] passed threads={threads:d}  ranks={ranks:d}
+echo [$SECONDS] PWD=$PWD
+
+
+KOKKOS_VERSION=4.1.00
+KOKKOS_ARCH=Kokkos_ARCH_AMPERE80
+KOKKOS_BUILD=Release
+
+KOKKOS_STRING=kokkos-$KOKKOS_VERSION/$KOKKOS_ARCH/$KOKKOS_BUILD
+
+PROJ_PATH=/lus/grand/projects/datascience/parton
+KOKKOS_PATH=$PROJ_PATH/kokkos/$KOKKOS_STRING
+PEPPER_PATH=/home/parton/git/pepper/build/$KOKKOS_STRING
+
+source $KOKKOS_PATH/setup.sh
+module load cray-hdf5-parallel
+
+export PEPPER_DATA_PATH=$PROJ_PATH/pepper_data
+
+cat << EOF > pepper_config.ini
+[main]
+process = {process}
+batch_size = {threads:d}
+n_batches = {n_batches:d}
+seed = {seed:d}
+collision_energy = 14000
+mu2 = H_T^2/2
+verbosity = info
+
+[phase_space]
+use_cached_results = true
+cache_path = $PROJ_PATH/pepper_cache
+integrator = Chili(basic)
+
+# [phase_space.chili]
+# num_s_channels   = 99
+# start_vegas_bins = 100
+# max_vegas_bins   = 100
+
+# [cuts]
+# jets.pt_min = 0.01
+# jets.nu_max = 5
+# jets.dR_min = 0.4
+# ll.m_min    = 66
+# ll.m_max    = 116
+
+[events]
+output_path = event_data.hdf5
+
+[dev]
+diagnostic_output_enabled = true
+EOF
+
+cat << EOF > parallel_config.json
+{{
+   "N Ranks": $NRANKS,
+   "Ranks per Node": $RANKS_PER_NODE,
+   "N Nodes": $NUM_NODES
+}}
+EOF
+
+echo [$SECONDS] pepper start
+srun -N $NUM_NODES -n $NRANKS --ntasks-per-node $RANKS_PER_NODE {profile_launch}$PEPPER_PATH/{executable} pepper_config.ini
+PEPPER_STATUS=$?
+echo [$SECONDS] pepper done
+{profile_collect}
+# the exit code tells the campaign state whether the point has to be resubmitted
+exit $PEPPER_STATUS